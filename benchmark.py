@@ -0,0 +1,403 @@
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+this_dir = Path(__file__).parent.resolve()
+
+# AllTalk performance benchmarks. Run from the alltalk_tts folder inside its Python environment e.g.
+#   python benchmark.py conditioning
+# Each benchmark loads the model configured in confignew.json / modeldownload.json.
+
+
+# Load tts_server (and the configured model) only when a benchmark needs it
+def load_server():
+    import tts_server
+    asyncio.run(tts_server.setup())
+    return tts_server
+
+
+def print_result(name, value, unit=""):
+    print(f"\033[94m{name:<40}\033[0m \033[93m{value}\033[0m {unit}")
+
+
+########################################
+#### CONDITIONING LATENT EXTRACTION ####
+########################################
+def bench_conditioning(args):
+    server = load_server()
+    voice_paths = [this_dir / "voices" / voice for voice in server.list_files(this_dir / "voices")][: args.voices]
+    if not voice_paths:
+        print("\033[91mNo wav files found in the voices folder.\033[0m")
+        return
+    settings = {
+        "gpt_cond_len": server.model.config.gpt_cond_len,
+        "max_ref_length": server.model.config.max_ref_len,
+        "sound_norm_refs": server.model.config.sound_norm_refs,
+    }
+    # One untimed pass so lazy initialisation is not counted against either path
+    server.extract_conditioning_batch(voice_paths[:1], **settings)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for voice_path in voice_paths:
+            server.model.get_conditioning_latents(audio_path=[str(voice_path)], **settings)
+    sequential = (time.perf_counter() - start) / args.repeat
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        server.extract_conditioning_batch(voice_paths, **settings)
+    batched = (time.perf_counter() - start) / args.repeat
+
+    print_result("Voices", len(voice_paths))
+    print_result("Sequential get_conditioning_latents", f"{len(voice_paths) / sequential:.2f}", "voices/s")
+    print_result("Batched extract_conditioning_batch", f"{len(voice_paths) / batched:.2f}", "voices/s")
+    print_result("Speed up", f"{sequential / batched:.2f}", "x")
+    print_result("Padded speaker encoder batches", server.speaker_batching["padded"])
+    print_result("Max speaker embedding difference", server.speaker_batching["max_difference"], "(vs one clip at a time)")
+
+
+#######################################
+#### VOICE STORE PRECISION QUALITY ####
+#######################################
+def harvard_sentences(count):
+    with open(this_dir / "harvard_sentences.txt", encoding="utf8") as f:
+        return [line.strip() for line in f if line.strip()][:count]
+
+
+# Speaker embedding of generated audio, used to compare two renders of the same text for voice drift
+def output_speaker(server, wav):
+    import torchaudio
+    audio_16k = torchaudio.functional.resample(wav[None, :].to(server.model.device), 24000, 16000)
+    return server.model.hifigan_decoder.speaker_encoder.forward(audio_16k, l2_norm=True).squeeze(0)
+
+
+def bench_voice_precision(args):
+    import torch
+    server = load_server()
+    voice_paths = [this_dir / "voices" / voice for voice in server.list_files(this_dir / "voices")][: args.voices]
+    sentences = harvard_sentences(args.sentences)
+    reference = server.extract_conditioning_batch(
+        voice_paths,
+        gpt_cond_len=server.model.config.gpt_cond_len,
+        max_ref_length=server.model.config.max_ref_len,
+        sound_norm_refs=server.model.config.sound_norm_refs,
+    )
+
+    def synthesize(gpt_cond_latent, speaker_embedding, text):
+        # Greedy decoding so any difference comes from the conditioning and not from sampling
+        output = server.model.inference(
+            text, "en", gpt_cond_latent, speaker_embedding, do_sample=False, enable_text_splitting=True
+        )
+        return torch.tensor(output["wav"])
+
+    baseline = [[synthesize(*latents, text) for text in sentences] for latents in reference]
+    fp32_bytes = sum(latent.numel() * 4 + embedding.numel() * 4 for latent, embedding in reference) / len(reference)
+    print_result("Voices x sentences", f"{len(reference)} x {len(sentences)}")
+    print_result("fp32 bytes per voice", f"{fp32_bytes:.0f}")
+    for precision in ("fp16", "int8"):
+        stored_bytes = 0
+        latent_cosine = []
+        speaker_cosine = []
+        for (gpt_cond_latent, speaker_embedding), baseline_wavs in zip(reference, baseline):
+            quantized = [server.quantize_tensor(tensor, precision) for tensor in (gpt_cond_latent, speaker_embedding)]
+            stored_bytes += sum(stored.numel() * stored.element_size() + (4 if scale is not None else 0) for stored, scale in quantized)
+            restored = [server.dequantize_tensor(stored, scale) for stored, scale in quantized]
+            latent_cosine.append(torch.nn.functional.cosine_similarity(
+                gpt_cond_latent.flatten().to(restored[0].device), restored[0].flatten(), dim=0
+            ).item())
+            for text, baseline_wav in zip(sentences, baseline_wavs):
+                wav = synthesize(restored[0], restored[1], text)
+                speaker_cosine.append(torch.dot(output_speaker(server, wav), output_speaker(server, baseline_wav)).item())
+        print_result(f"{precision} bytes per voice", f"{stored_bytes / len(reference):.0f}", f"({fp32_bytes * len(reference) / stored_bytes:.1f}x smaller)")
+        print_result(f"{precision} min latent cosine vs fp32", f"{min(latent_cosine):.5f}")
+        print_result(f"{precision} output speaker similarity vs fp32", f"mean {sum(speaker_cosine) / len(speaker_cosine):.4f} min {min(speaker_cosine):.4f}")
+
+
+##########################################
+#### MICRO-BATCHING UNDER CONCURRENCY ####
+##########################################
+def bench_batching(args):
+    server = load_server()
+    voice_path = this_dir / "voices" / server.list_files(this_dir / "voices")[0]
+    gpt_cond_latent, speaker_embedding = server.get_speaker_latents(voice_path)
+    sentences = harvard_sentences(args.requests)
+    inference_args = {
+        "language": "en",
+        "gpt_cond_latent": gpt_cond_latent,
+        "speaker_embedding": speaker_embedding,
+        "temperature": float(server.model.config.temperature),
+        "length_penalty": float(server.model.config.length_penalty),
+        "repetition_penalty": float(server.model.config.repetition_penalty),
+        "top_k": int(server.model.config.top_k),
+        "top_p": float(server.model.config.top_p),
+        "enable_text_splitting": True,
+        "speed": 1.0,
+    }
+
+    async def concurrent_load(batch_size):
+        server.micro_batcher.max_batch_size = batch_size
+        start = time.perf_counter()
+        outputs = await asyncio.gather(*[server.xtts_inference(dict(inference_args, text=text)) for text in sentences])
+        elapsed = time.perf_counter() - start
+        audio_seconds = sum(len(output["wav"]) for output in outputs) / 24000
+        return elapsed, audio_seconds
+
+    async def run():
+        await concurrent_load(1)  # Warm up
+        for batch_size in (1, args.batch_size):
+            elapsed, audio_seconds = await concurrent_load(batch_size)
+            print_result(f"Batch size {batch_size} wall time", f"{elapsed:.2f}", "s")
+            print_result(f"Batch size {batch_size} aggregate RTF", f"{elapsed / audio_seconds:.3f}", "(lower is better)")
+        print_result("Batch size histogram", server.micro_batcher.stats()["batch_size_histogram"])
+
+    print_result("Concurrent requests", len(sentences))
+    asyncio.run(run())
+
+
+###############################
+#### CPU INFERENCE PROFILE ####
+###############################
+def bench_cpu_profile(args):
+    import torch
+    import tts_server as server
+    # Load plain fp32 first so the same process can measure the baseline and then the chosen profile
+    server.params["cpu_profile"] = "fp32"
+    server.params["cpu_compile"] = False
+    asyncio.run(server.setup())
+    if str(server.device) != "cpu":
+        print("\033[91mThe cpu-profile benchmark needs the model loaded on the CPU.\033[0m")
+        return
+    voice_path = this_dir / "voices" / server.list_files(this_dir / "voices")[0]
+    gpt_cond_latent, speaker_embedding = server.get_speaker_latents(voice_path)
+    sentences = harvard_sentences(args.sentences)
+
+    def render():
+        wavs = []
+        start = time.perf_counter()
+        for text in sentences:
+            # Greedy decoding so any difference comes from the profile and not from sampling
+            output = server.xtts_inference_job(
+                text=text, language="en", gpt_cond_latent=gpt_cond_latent, speaker_embedding=speaker_embedding,
+                do_sample=False, enable_text_splitting=True,
+            )
+            wavs.append(torch.tensor(output["wav"]).float())
+        elapsed = time.perf_counter() - start
+        return wavs, elapsed / (sum(len(wav) for wav in wavs) / 24000)
+
+    render()  # Warm up
+    baseline, baseline_rtf = render()
+    server.apply_cpu_profile(server.model, args.profile, args.compile)
+    if args.compile:
+        render()  # Graph compilation happens on the first calls
+    wavs, rtf = render()
+    speaker_cosine = [torch.dot(output_speaker(server, wav), output_speaker(server, ref)).item() for wav, ref in zip(wavs, baseline)]
+    duration_ratio = [len(wav) / len(ref) for wav, ref in zip(wavs, baseline)]
+    profile = server.cpu_profile_state["profile"] + (" compiled" if server.cpu_profile_state["compiled"] else "")
+    print_result("Sentences", len(sentences))
+    print_result("fp32 RTF", f"{baseline_rtf:.3f}", "(lower is better)")
+    print_result(f"{profile} RTF", f"{rtf:.3f}", f"({baseline_rtf / rtf:.2f}x)")
+    print_result(f"{profile} output speaker similarity vs fp32", f"mean {sum(speaker_cosine) / len(speaker_cosine):.4f} min {min(speaker_cosine):.4f}")
+    print_result(f"{profile} duration vs fp32", f"min {min(duration_ratio):.2f} max {max(duration_ratio):.2f}", "x")
+
+
+#################################
+#### TAIL LATENCY UNDER LOAD ####
+#################################
+def bench_load(args):
+    import tts_server as server
+    # Run once as configured and once with --no-topology to compare the two
+    if args.no_topology:
+        server.params["cpu_topology"] = False
+        server.cpu_topology.enabled = False
+    server.cpu_topology.apply(server.inference_executor.workers, server.inference_executor.processes)
+    asyncio.run(server.setup())
+    voice_path = this_dir / "voices" / server.list_files(this_dir / "voices")[0]
+    gpt_cond_latent, speaker_embedding = server.get_speaker_latents(voice_path)
+    sentences = harvard_sentences(args.requests)
+    output_folder = this_dir / "outputs"
+    output_folder.mkdir(exist_ok=True)
+    common_args = {
+        "language": "en",
+        "gpt_cond_latent": gpt_cond_latent,
+        "speaker_embedding": speaker_embedding,
+        "temperature": float(server.model.config.temperature),
+        "length_penalty": float(server.model.config.length_penalty),
+        "repetition_penalty": float(server.model.config.repetition_penalty),
+        "top_k": int(server.model.config.top_k),
+        "top_p": float(server.model.config.top_p),
+        "enable_text_splitting": True,
+        "speed": 1.0,
+    }
+
+    async def one_request(index, text):
+        start = time.perf_counter()
+        await server.generate_xtts_file(
+            dict(common_args, text=text), output_folder / f"benchmark_load_{index}.mp3", args.pitch, lambda: server.voice_identity(voice_path),
+            use_cache=False,
+        )
+        return time.perf_counter() - start
+
+    async def run():
+        await one_request(0, sentences[0])  # Warm up
+        start = time.perf_counter()
+        latencies = sorted(await asyncio.gather(*[one_request(index, text) for index, text in enumerate(sentences)]))
+        elapsed = time.perf_counter() - start
+        for percentile in (50, 95, 99):
+            print_result(f"p{percentile} request latency", f"{latencies[min(len(latencies) * percentile // 100, len(latencies) - 1)]:.2f}", "s")
+        print_result("Wall time", f"{elapsed:.2f}", "s")
+
+    print_result("Concurrent requests", len(sentences))
+    print_result("CPU topology", "on" if server.cpu_topology.applied else "off")
+    asyncio.run(run())
+    for index in range(len(sentences)):
+        for suffix in (".mp3", ".wav"):
+            (output_folder / f"benchmark_load_{index}{suffix}").unlink(missing_ok=True)
+
+
+###############################
+#### STREAMING PCM ENCODER ####
+###############################
+def bench_pcm_encoder(args):
+    import numpy as np
+    import torch
+    import tts_server as server
+
+    # The conversion the streaming loop used to do for every chunk
+    def legacy(chunk):
+        chunk = chunk.clone().detach().cpu().numpy()
+        chunk = chunk[None, : int(chunk.shape[0])]
+        chunk = np.clip(chunk, -1, 1)
+        chunk = (chunk * 32767).astype(np.int16)
+        return chunk.tobytes()
+
+    encoder = server.PCM16Encoder()
+    # Roughly 1024 samples of audio per GPT token
+    chunks = [torch.rand(args.tokens * 1024, device=args.device) * 2.2 - 1.1 for _ in range(args.chunks)]
+    assert legacy(chunks[0]) == bytes(encoder.encode(chunks[0]))
+
+    def per_chunk(convert):
+        for chunk in chunks[:8]:
+            convert(chunk)  # Warm up, and lets the encoder grow its buffers
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for chunk in chunks:
+            convert(chunk)
+        return (time.perf_counter() - start) / len(chunks) * 1e6
+
+    legacy_us = per_chunk(legacy)
+    encoder_us = per_chunk(encoder.encode)
+    print_result("Chunks x samples", f"{len(chunks)} x {args.tokens * 1024} on {args.device}")
+    print_result("Previous conversion", f"{legacy_us:.1f}", "us/chunk")
+    print_result("PCM16Encoder", f"{encoder_us:.1f}", "us/chunk")
+    print_result("Speed up", f"{legacy_us / encoder_us:.2f}", "x")
+    print_result("Encoder buffer memory", sum(slot.numel() * 2 for slot in encoder.slots if slot is not None) + encoder.scratch.numel() * 4, "bytes")
+
+
+############################
+#### STREAM COMPRESSION ####
+############################
+def bench_stream_codecs(args):
+    import io
+    import wave
+    import librosa
+    import numpy as np
+    import tts_server as server
+    voice_path = this_dir / "voices" / server.list_files(this_dir / "voices")[0]
+    audio, _ = librosa.load(voice_path, sr=24000)
+    pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes()
+    wav_buf = io.BytesIO()
+    with wave.open(wav_buf, "wb") as header:
+        header.setnchannels(1)
+        header.setsampwidth(2)
+        header.setframerate(24000)
+    chunk_bytes = args.tokens * 1024 * 2
+    chunks = [pcm[start:start + chunk_bytes] for start in range(0, len(pcm), chunk_bytes)]
+    audio_seconds = len(pcm) / 2 / 24000
+
+    async def measure(audio_format):
+        written = []
+
+        # Chunks arrive args.pace times faster than real time, like a worker ahead of playback
+        async def source():
+            yield wav_buf.getvalue()
+            for chunk in chunks:
+                written.append(time.perf_counter())
+                yield chunk
+                await asyncio.sleep(len(chunk) / 2 / 24000 / args.pace)
+
+        stream = source() if audio_format == "wav" else server.encode_stream(source(), audio_format)
+        arrivals = []
+        total = 0
+        async for data in stream:
+            arrivals.append(time.perf_counter())
+            total += len(data)
+        # Added latency of a chunk: from handing it over to the next encoded output after it
+        delays = sorted(next((arrival for arrival in arrivals if arrival >= sent), arrivals[-1]) - sent for sent in written)
+        return total * 8 / audio_seconds / 1000, delays
+
+    async def run():
+        print_result("Audio", f"{audio_seconds:.1f} s from {voice_path.name}, {len(chunks)} chunks")
+        for audio_format in ("wav", "opus", "mp3"):
+            kbps, delays = await measure(audio_format)
+            print_result(f"{audio_format} bandwidth", f"{kbps:.1f}", "kbit/s")
+            print_result(f"{audio_format} added latency", f"min {delays[0] * 1000:.1f} p50 {delays[len(delays) // 2] * 1000:.1f} p95 {delays[int(len(delays) * 0.95)] * 1000:.1f}", "ms")
+
+    try:
+        server.stream_codec("opus")
+    except server.HTTPException as e:
+        print(f"\033[91m{e.detail}\033[0m")
+        return
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AllTalk performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    conditioning = subparsers.add_parser("conditioning", help="Sequential vs batched conditioning latent extraction")
+    conditioning.add_argument("--voices", type=int, default=32, help="Maximum number of wavs from the voices folder")
+    conditioning.add_argument("--repeat", type=int, default=3)
+    conditioning.set_defaults(func=bench_conditioning)
+
+    voice_precision = subparsers.add_parser("voice-precision", help="fp16/int8 voice storage size and output quality against fp32")
+    voice_precision.add_argument("--voices", type=int, default=4, help="Maximum number of wavs from the voices folder")
+    voice_precision.add_argument("--sentences", type=int, default=5, help="Number of Harvard sentences to synthesize per voice")
+    voice_precision.set_defaults(func=bench_voice_precision)
+
+    batching = subparsers.add_parser("batching", help="Aggregate RTF of concurrent requests with and without micro-batching")
+    batching.add_argument("--requests", type=int, default=8, help="Number of concurrent requests, one Harvard sentence each")
+    batching.add_argument("--batch-size", type=int, default=4)
+    batching.set_defaults(func=bench_batching)
+
+    cpu_profile = subparsers.add_parser("cpu-profile", help="RTF and output quality of a CPU inference profile against fp32")
+    cpu_profile.add_argument("--profile", choices=["fp32", "int8", "bf16"], default="int8")
+    cpu_profile.add_argument("--compile", action="store_true", help="Also wrap the GPT transformer and HiFi-GAN with torch.compile")
+    cpu_profile.add_argument("--sentences", type=int, default=5, help="Number of Harvard sentences to synthesize")
+    cpu_profile.set_defaults(func=bench_cpu_profile)
+
+    load = subparsers.add_parser("load", help="Request latency percentiles for concurrent file generations")
+    load.add_argument("--requests", type=int, default=16, help="Number of concurrent requests, one Harvard sentence each")
+    load.add_argument("--pitch", type=int, default=0, help="Pitch shift, which adds encoding work per request")
+    load.add_argument("--no-topology", action="store_true", help="Leave threads and core placement to torch and the OS")
+    load.set_defaults(func=bench_load)
+
+    pcm_encoder = subparsers.add_parser("pcm-encoder", help="Per chunk cost of converting streamed audio to PCM16")
+    pcm_encoder.add_argument("--chunks", type=int, default=500)
+    pcm_encoder.add_argument("--tokens", type=int, default=20, help="GPT tokens per chunk")
+    pcm_encoder.add_argument("--device", choices=["cpu", "cuda"], default="cpu")
+    pcm_encoder.set_defaults(func=bench_pcm_encoder)
+
+    stream_codecs = subparsers.add_parser("stream-codecs", help="Bandwidth and added latency of compressed stream formats")
+    stream_codecs.add_argument("--tokens", type=int, default=20, help="GPT tokens per streamed chunk")
+    stream_codecs.add_argument("--pace", type=float, default=4.0, help="How many times faster than real time chunks arrive")
+    stream_codecs.set_defaults(func=bench_stream_codecs)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
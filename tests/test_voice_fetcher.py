@@ -0,0 +1,115 @@
+import asyncio
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+# tts_server loads its dependencies at import time, skip when the full environment is not installed
+for module in ("torch", "torchaudio", "TTS", "whisper", "librosa", "pyrubberband", "pydub", "soundfile", "fastapi", "httpx"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import httpx  # noqa: E402
+import tts_server  # noqa: E402
+
+VOICE = b"RIFF" + b"\x00" * 1024
+ETAG = '"voice-1"'
+
+
+class VoiceServer(BaseHTTPRequestHandler):
+    # Shared state, reset by the fixture
+    requests = []
+    delay = 0.0
+    failing = False
+
+    def do_GET(self):
+        VoiceServer.requests.append({name.lower(): value for name, value in self.headers.items()})
+        time.sleep(VoiceServer.delay)
+        if VoiceServer.failing:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(VOICE)))
+        self.end_headers()
+        self.wfile.write(VOICE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def voice_url():
+    VoiceServer.requests = []
+    VoiceServer.delay = 0.0
+    VoiceServer.failing = False
+    server = ThreadingHTTPServer(("127.0.0.1", 0), VoiceServer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/voice.wav"
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetcher(cache_dir, revalidate_after=3600):
+    return tts_server.VoiceFetcher(
+        cache_dir, max_download_bytes=1024 * 1024, max_cache_bytes=16 * 1024 * 1024, timeout=5, revalidate_after=revalidate_after
+    )
+
+
+# Runs the steps one after another on one event loop, the fetcher's client is bound to it
+def run(fetcher, *steps):
+    async def main():
+        try:
+            return [await step() for step in steps]
+        finally:
+            await fetcher.close()
+    return asyncio.run(main())
+
+
+def test_concurrent_fetches_share_one_download(tmp_path, voice_url):
+    VoiceServer.delay = 0.3
+    fetcher = make_fetcher(tmp_path)
+    [paths] = run(fetcher, lambda: asyncio.gather(*[fetcher.fetch(voice_url) for _ in range(5)]))
+    assert len(VoiceServer.requests) == 1
+    assert len(set(paths)) == 1
+    assert Path(paths[0]).read_bytes() == VOICE
+
+
+def test_revalidation_uses_a_conditional_get(tmp_path, voice_url):
+    fetcher = make_fetcher(tmp_path, revalidate_after=0)
+    first, second = run(fetcher, lambda: fetcher.fetch(voice_url), lambda: fetcher.fetch(voice_url))
+    assert first == second
+    assert len(VoiceServer.requests) == 2
+    assert "if-none-match" not in VoiceServer.requests[0]
+    assert VoiceServer.requests[1]["if-none-match"] == ETAG
+    assert Path(second).read_bytes() == VOICE
+
+
+def test_failed_revalidation_serves_the_cached_copy(tmp_path, voice_url):
+    fetcher = make_fetcher(tmp_path, revalidate_after=0)
+
+    async def fetch_while_failing():
+        VoiceServer.failing = True
+        return await fetcher.fetch(voice_url)
+
+    first, stale = run(fetcher, lambda: fetcher.fetch(voice_url), fetch_while_failing)
+    assert stale == first
+    assert Path(stale).read_bytes() == VOICE
+    assert len(VoiceServer.requests) == 2
+
+
+def test_failed_download_without_a_cached_copy_raises(tmp_path, voice_url):
+    VoiceServer.failing = True
+    fetcher = make_fetcher(tmp_path)
+    with pytest.raises(httpx.HTTPStatusError):
+        run(fetcher, lambda: fetcher.fetch(voice_url))
@@ -5,7 +5,8 @@ from pathlib import Path
 import torch
 import torchaudio
 from TTS.tts.configs.xtts_config import XttsConfig
-from TTS.tts.models.xtts import Xtts
+from TTS.tts.models.xtts import Xtts, load_audio, wav_to_mel_cloning
+from TTS.tts.layers.xtts.tokenizer import split_sentence
 import io
 import wave
 from pydub import AudioSegment
@@ -19,6 +20,18 @@ import re
 import whisper
 import asyncio
 import pyrubberband
+import hashlib
+import unicodedata
+import inspect
+import contextlib
+import math
+import threading
+import functools
+import multiprocessing
+import struct
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from collections import OrderedDict, deque
 
 ##########################
 #### Webserver Imports####
@@ -31,8 +44,12 @@ from fastapi import (
     Depends,
     HTTPException,
     File,
-    UploadFile
+    UploadFile,
+    Query,
+    WebSocket,
+    WebSocketDisconnect
 )
+from starlette.requests import Request as HTTPRequest
 from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
@@ -40,7 +57,6 @@ from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 
 from urllib.parse import urlparse
-import requests
 from urllib.parse import unquote
 import httpx
 import shutil
@@ -153,9 +169,16 @@ else:
 
 @asynccontextmanager
 async def startup_shutdown(no_actual_value_it_demanded_something_be_here):
+    cpu_topology.apply(inference_executor.workers, inference_executor.processes)
+    inference_executor.start()
     await setup()
     yield
     # Shutdown logic
+    await inference_executor.stop()
+    await voice_fetcher.close()
+    voice_prewarmer.save_usage()
+    result_cache.save()
+    cpu_topology.stop()
 
 
 # Create FastAPI app with lifespan
@@ -216,10 +239,19 @@ async def setup():
     )
     # Set "tts_model_loaded" to true
     params["tts_model_loaded"] = True
+    # Load the character voice embeddings once, onto the device the model is now using
+    voice_embedding_store.load()
+    # Bring the latent cache folder back under its size limit
+    speaker_latent_cache.prune()
+    # Fork the inference worker processes, if configured, now the weights are loaded
+    inference_executor.start_processes()
     # Set the output path for wav files
     output_directory = this_dir / params["output_folder_wav_standalone"]
     output_directory.mkdir(parents=True, exist_ok=True)
     #Path(f'this_folder/outputs/').mkdir(parents=True, exist_ok=True)
+    # Compute conditioning for the voice library in the background, the server answers requests meanwhile
+    if params.get("prewarm_voices", False) and (params["tts_method_xtts_local"] or tts_method_xtts_ft):
+        voice_prewarmer.start()
 
 
 # MODEL LOADER For "API TTS"
@@ -276,6 +308,7 @@ async def xtts_manual_load_model():
         use_deepspeed=params["deepspeed_activate"],
     )
     model.to(device)
+    apply_cpu_profile(model)
     return model
 
 # MODEL LOADER For "XTTSv2 FT"
@@ -294,8 +327,100 @@ async def xtts_ft_manual_load_model():
         use_deepspeed=params["deepspeed_activate"],
     )
     model.to(device)
+    apply_cpu_profile(model)
     return model
 
+###############################
+#### CPU INFERENCE PROFILE ####
+###############################
+# Optional speed ups for XTTS on the CPU, picked with "cpu_profile" in confignew.json and applied once at load:
+#   fp32  the model as loaded
+#   int8  dynamic int8 quantization of the GPT transformer's linear layers, where nearly all CPU time goes
+#   bf16  the GPT transformer runs under bfloat16 autocast, on CPUs with native bf16 (AVX512-BF16 or AMX)
+# "cpu_compile" additionally wraps the GPT transformer and the HiFi-GAN decoder with torch.compile. The first
+# generations after loading are slow while the graphs compile. Model jobs run under torch.inference_mode either way.
+cpu_profile_state = {"profile": "fp32", "compiled": False, "bf16_supported": None}
+
+
+def cpu_supports_bf16():
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+# HF GPT-2 keeps its projections in transformers' Conv1D (a transposed Linear) which quantize_dynamic does not know
+def conv1d_to_linear(module):
+    for name, child in module.named_children():
+        if type(child).__name__ == "Conv1D" and hasattr(child, "nf"):
+            linear = torch.nn.Linear(child.weight.shape[0], child.nf, bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
+
+class Bf16Autocast(torch.nn.Module):
+    """
+    Runs the wrapped GPT-2 transformer under CPU bfloat16 autocast and hands the hidden states back as float32,
+    so the XTTS heads, the latent pass and HiFi-GAN outside it stay in full precision.
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            output = self.module(*args, **kwargs)
+        if isinstance(output, tuple):
+            return (output[0].float(),) + output[1:]
+        output.last_hidden_state = output.last_hidden_state.float()
+        return output
+
+
+# GPT2InferenceModel keeps its own reference to the transformer, so both have to point at the replacement
+def replace_gpt_transformer(loaded_model, transformer):
+    loaded_model.gpt.gpt = transformer
+    if getattr(loaded_model.gpt, "gpt_inference", None) is not None:
+        loaded_model.gpt.gpt_inference.transformer = transformer
+
+
+def apply_cpu_profile(loaded_model, profile=None, compile_modules=None):
+    profile = profile or params.get("cpu_profile", "fp32")
+    compile_modules = params.get("cpu_compile", False) if compile_modules is None else compile_modules
+    cpu_profile_state.update({"profile": "fp32", "compiled": False})
+    if str(device) != "cpu" or params["deepspeed_activate"]:
+        return loaded_model
+    loaded_model.eval()
+    if profile == "int8":
+        conv1d_to_linear(loaded_model.gpt.gpt)
+        torch.ao.quantization.quantize_dynamic(loaded_model.gpt.gpt, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        cpu_profile_state["profile"] = "int8"
+    elif profile == "bf16":
+        cpu_profile_state["bf16_supported"] = cpu_supports_bf16()
+        if cpu_profile_state["bf16_supported"]:
+            replace_gpt_transformer(loaded_model, Bf16Autocast(loaded_model.gpt.gpt))
+            cpu_profile_state["profile"] = "bf16"
+        else:
+            print(f"[{params['branding']}Model] \033[91mWarning\033[0m This CPU has no native bf16 support, staying on fp32")
+    elif profile != "fp32":
+        print(f"[{params['branding']}Model] \033[91mWarning\033[0m Unknown cpu_profile '{profile}', staying on fp32")
+    if compile_modules and hasattr(torch, "compile"):
+        replace_gpt_transformer(loaded_model, torch.compile(loaded_model.gpt.gpt, dynamic=True))
+        decoder = loaded_model.hifigan_decoder
+        decoder.waveform_decoder = torch.compile(decoder.waveform_decoder, dynamic=True)
+        cpu_profile_state["compiled"] = True
+    print(
+        f"[{params['branding']}Model] \033[94mCPU profile\033[0m {cpu_profile_state['profile']}"
+        f"{' (compiled)' if cpu_profile_state['compiled'] else ''}"
+    )
+    return loaded_model
+
+
 # MODEL UNLOADER
 async def unload_model(model):
     print(f"[{params['branding']}Model] \033[94mUnloading model \033[0m")
@@ -345,21 +470,165 @@ async def handle_tts_method_change(tts_method):
     await setup()
 
 
-def check_or_download_voice(voice_url: string):
-    local_voice_dir = "./voices/"
-    filename = os.path.basename(urlparse(voice_url).path)
-    local_voice_path = os.path.join(local_voice_dir, filename)
-    
-    if os.path.exists(local_voice_path):
-        return os.path.abspath(local_voice_path)
-    else:
-        print(f"Downloading voice file from {voice_url}...")
-        os.makedirs(local_voice_dir, exist_ok=True)
-        response = requests.get(voice_url)
-        with open(local_voice_path, "wb") as f:
-            f.write(response.content)
-        print(f"Voice file downloaded and saved to {local_voice_path}")
-        return os.path.abspath(local_voice_path)
+#######################
+#### VOICE FETCHER ####
+#######################
+class VoiceFetcher:
+    """
+    Downloads remote reference wavs for /api/v1/tts without blocking the event loop. All downloads share
+    one pooled httpx.AsyncClient, and concurrent requests for the same URL wait on a single download.
+    Files are stored under their SHA-256 so different URLs with the same file name never collide.
+    Cached URLs are revalidated with ETag/If-Modified-Since once they are older than revalidate_after;
+    if the server cannot be reached or answers with an error, the cached copy is served and a warning
+    logged. The cache folder is kept under max_cache_bytes by evicting the least recently used files.
+    """
+    def __init__(self, cache_dir, max_download_bytes, max_cache_bytes, timeout, revalidate_after):
+        self.cache_dir = Path(cache_dir)
+        self.max_download_bytes = int(max_download_bytes)
+        self.max_cache_bytes = int(max_cache_bytes)
+        self.timeout = float(timeout)
+        self.revalidate_after = float(revalidate_after)
+        self.index_path = self.cache_dir / "index.json"
+        self.index = None
+        self.inflight = {}
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+                follow_redirects=True,
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def fetch(self, voice_url):
+        # Anything that is not an http(s) URL is treated as the name of a wav in the voices folder
+        if urlparse(voice_url).scheme not in ("http", "https"):
+            local_voice_path = this_dir / "voices" / os.path.basename(voice_url)
+            if not local_voice_path.is_file():
+                raise ValueError(f"Voice '{voice_url}' is neither a URL nor a file in the voices folder.")
+            return str(local_voice_path)
+        entry = self._load_index().get(voice_url)
+        if entry is not None and (self.cache_dir / entry["file"]).is_file() and time.time() - entry["checked"] < self.revalidate_after:
+            entry["used"] = time.time()
+            return str(self.cache_dir / entry["file"])
+        download = self.inflight.get(voice_url)
+        if download is None:
+            download = asyncio.ensure_future(self._download_or_stale(voice_url))
+            self.inflight[voice_url] = download
+            download.add_done_callback(lambda _: self.inflight.pop(voice_url, None))
+        # Shield the shared download so one caller going away does not cancel it for the others
+        return await asyncio.shield(download)
+
+    async def _download_or_stale(self, voice_url):
+        try:
+            return await asyncio.wait_for(self._download(voice_url), timeout=self.timeout)
+        except (httpx.HTTPError, asyncio.TimeoutError, OSError) as e:
+            entry = self._load_index().get(voice_url)
+            if entry is None or not (self.cache_dir / entry["file"]).is_file():
+                raise
+            # Left unchecked, so the next request tries the server again
+            print(f"[{params['branding']}TTSGen] \033[91mWarning\033[0m Could not revalidate {voice_url}, using the cached copy: {e!r}")
+            entry["used"] = time.time()
+            return str(self.cache_dir / entry["file"])
+
+    async def _download(self, voice_url):
+        index = self._load_index()
+        entry = index.get(voice_url)
+        headers = {}
+        if entry is not None and (self.cache_dir / entry["file"]).is_file():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.cache_dir / f"download_{uuid.uuid4().hex}.tmp"
+        try:
+            async with self.get_client().stream("GET", voice_url, headers=headers) as response:
+                if response.status_code == 304:
+                    entry["checked"] = entry["used"] = time.time()
+                    self._save_index()
+                    return str(self.cache_dir / entry["file"])
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > self.max_download_bytes:
+                    raise ValueError(f"Voice file at {voice_url} is larger than the {self.max_download_bytes} byte limit.")
+                print(f"[{params['branding']}TTSGen] Downloading voice file from {voice_url}")
+                sha256 = hashlib.sha256()
+                received = 0
+                with open(temp_path, "wb") as temp_file:
+                    async for block in response.aiter_bytes():
+                        received += len(block)
+                        if received > self.max_download_bytes:
+                            raise ValueError(f"Voice file at {voice_url} is larger than the {self.max_download_bytes} byte limit.")
+                        sha256.update(block)
+                        temp_file.write(block)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        suffix = Path(urlparse(voice_url).path).suffix or ".wav"
+        file_name = f"{sha256.hexdigest()}{suffix}"
+        os.replace(temp_path, self.cache_dir / file_name)
+        now = time.time()
+        index[voice_url] = {
+            "file": file_name,
+            "size": received,
+            "etag": etag,
+            "last_modified": last_modified,
+            "checked": now,
+            "used": now,
+        }
+        self._evict(keep=file_name)
+        self._save_index()
+        return str(self.cache_dir / file_name)
+
+    def _evict(self, keep=None):
+        index = self._load_index()
+        files = {}
+        for voice_url, entry in index.items():
+            used, size = files.get(entry["file"], (0, entry["size"]))
+            files[entry["file"]] = (max(used, entry["used"]), size)
+        total = sum(size for _, size in files.values())
+        for file_name, (_, size) in sorted(files.items(), key=lambda item: item[1][0]):
+            if total <= self.max_cache_bytes:
+                break
+            if file_name == keep:
+                continue
+            (self.cache_dir / file_name).unlink(missing_ok=True)
+            for voice_url in [voice_url for voice_url, entry in index.items() if entry["file"] == file_name]:
+                del index[voice_url]
+            total -= size
+
+    def _load_index(self):
+        if self.index is None:
+            try:
+                with open(self.index_path, "r") as index_file:
+                    self.index = json.load(index_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.index = {}
+        return self.index
+
+    def _save_index(self):
+        temp_path = self.index_path.with_suffix(".tmp")
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
+
+
+voice_fetcher = VoiceFetcher(
+    this_dir / "voices" / "remote",
+    max_download_bytes=float(params.get("voice_fetch_max_mb", 20)) * 1024 * 1024,
+    max_cache_bytes=float(params.get("voice_fetch_cache_mb", 512)) * 1024 * 1024,
+    timeout=params.get("voice_fetch_timeout", 30),
+    revalidate_after=params.get("voice_fetch_revalidate_seconds", 3600),
+)
 
 
 
@@ -393,6 +662,43 @@ async def switch_device():
             model.to(device)
 
 
+# LOW VRAM - Generations run concurrently, so the model is only moved by a count of the requests using it: onto the
+# GPU for the first, back to system RAM after the last. One request finishing never pulls the model out from under
+# another that is still generating.
+low_vram_users = 0
+low_vram_lock = asyncio.Lock()
+
+
+async def low_vram_acquire():
+    global low_vram_users
+    async with low_vram_lock:
+        low_vram_users += 1
+        if params["low_vram"] and device == "cpu":
+            await switch_device()
+
+
+async def low_vram_release():
+    global low_vram_users
+    async with low_vram_lock:
+        low_vram_users -= 1
+        if low_vram_users == 0 and params["low_vram"] and device == "cuda":
+            await switch_device()
+
+
+# Decorator for the generation functions (async generators): holds a low VRAM use for as long as the generation runs,
+# released however it ends, including an error or the client going away mid stream
+def uses_model(generation):
+    @functools.wraps(generation)
+    async def wrapper(*args, **kwargs):
+        await low_vram_acquire()
+        try:
+            async for chunk in generation(*args, **kwargs):
+                yield chunk
+        finally:
+            await low_vram_release()
+    return wrapper
+
+
 @app.post("/api/lowvramsetting")
 async def set_low_vram(request: Request, new_low_vram_value: bool):
     global device
@@ -515,53 +821,3044 @@ async def deepspeed(request: Request, new_deepspeed_value: bool):
         return Response(content=json.dumps({"status": "error", "message": str(e)}))
 
 
+##############################
+#### SPEAKER LATENT CACHE ####
+##############################
+# Identity of the currently loaded model, so conditioning computed by one checkpoint is never served to another
+def current_model_identity():
+    if tts_method_xtts_ft:
+        return "xtts_ft:" + str(this_dir / "models" / "trainedmodel")
+    if str(modeldownload_base_path) == "models":
+        return "xtts_local:" + str(this_dir / "models" / modeldownload_model_path)
+    return "xtts_local:" + str(modeldownload_base_path / modeldownload_model_path)
+
+
+class SpeakerLatentCache:
+    """
+    Cache of XTTS conditioning (gpt_cond_latent, speaker_embedding) keyed by the SHA-256 of the reference
+    wav plus the conditioning settings. Entries are held in memory with an LRU bound and persisted to
+    cache_dir so they survive restarts. A reference wav that changes on disk gets a new hash, and the
+    entries computed from its old contents are dropped from memory and disk. The files on disk are
+    bounded too: a disk hit refreshes the file's modification time, and once the folder is over
+    max_disk_bytes the least recently used files are deleted, at startup and whenever a write pushes it
+    over the limit. Files are read with weights_only, so a planted cache file cannot run code. Files are
+    written in the voice store's precision (see quantize_tensor) and upcast to float32 when read; the
+    entries kept in memory go through the same round trip, so a voice sounds the same before and after
+    a restart.
+    """
+    def __init__(self, cache_dir, max_entries=64, max_disk_bytes=256 * 1024 * 1024, precision="fp32"):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max(int(max_entries), 1)
+        self.precision = precision if precision in ("fp16", "int8") else "fp32"
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.disk_bytes = 0
+        self.entries = OrderedDict()
+        self.file_digests = {}
+        self.lock = threading.Lock()
+        self.prune_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    def file_digest(self, audio_path):
+        audio_path = str(audio_path)
+        stat = os.stat(audio_path)
+        with self.lock:
+            known = self.file_digests.get(audio_path)
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        sha256 = hashlib.sha256()
+        with open(audio_path, "rb") as audio_file:
+            for block in iter(lambda: audio_file.read(1024 * 1024), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        with self.lock:
+            self.file_digests[audio_path] = (stat.st_mtime_ns, stat.st_size, digest)
+        if known is not None and known[2] != digest:
+            self.invalidate(known[2])
+        return digest
+
+    def make_key(self, audio_path, gpt_cond_len, max_ref_len, sound_norm_refs):
+        digest = self.file_digest(audio_path)
+        model_tag = hashlib.sha256(current_model_identity().encode()).hexdigest()[:12]
+        # Reduced precision entries are kept apart, full precision keys are unchanged from before the option existed
+        precision_tag = "" if self.precision == "fp32" else f"_{self.precision}"
+        return f"{digest}_{model_tag}_{gpt_cond_len}_{max_ref_len}_{int(bool(sound_norm_refs))}{precision_tag}"
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        cache_file = self.cache_dir / f"{key}.pth"
+        if cache_file.exists():
+            try:
+                stored = torch.load(cache_file, map_location="cpu", weights_only=True)
+                latents = tuple(
+                    stored[field].float() * stored[f"{field}.scale"] if f"{field}.scale" in stored else stored[field].float()
+                    for field in ("gpt_cond_latent", "speaker_embedding")
+                )
+            except Exception as e:
+                print(f"[{params['branding']}Cache] \033[91mWarning\033[0m Discarding unreadable latent cache file {cache_file.name}: {e}")
+                cache_file.unlink(missing_ok=True)
+            else:
+                # Mark the file as recently used for pruning
+                with contextlib.suppress(OSError):
+                    os.utime(cache_file)
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, latents)
+                return latents
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, gpt_cond_latent, speaker_embedding):
+        stored = {}
+        latents = []
+        for field, tensor in (("gpt_cond_latent", gpt_cond_latent), ("speaker_embedding", speaker_embedding)):
+            stored[field], scale = quantize_tensor(tensor, self.precision)
+            latents.append(stored[field].float() if scale is None else stored[field].float() * scale)
+            if scale is not None:
+                stored[f"{field}.scale"] = scale
+        latents = tuple(latents)
+        self._remember(key, latents)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a half written entry behind
+        temp_file = self.cache_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save(stored, temp_file)
+        size = temp_file.stat().st_size
+        os.replace(temp_file, self.cache_dir / f"{key}.pth")
+        with self.lock:
+            self.disk_bytes += size
+            over = self.disk_bytes > self.max_disk_bytes
+        if over:
+            self.prune()
+        return latents
+
+    def is_cached(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return (self.cache_dir / f"{key}.pth").exists()
+
+    def invalidate(self, digest):
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(digest)]:
+                del self.entries[key]
+        for cache_file in self.cache_dir.glob(f"{digest}_*.pth"):
+            cache_file.unlink(missing_ok=True)
+
+    # Deletes the least recently used files until the folder is back under 90% of max_disk_bytes, so a full cache
+    # is not rescanned on every write
+    def prune(self):
+        if not self.prune_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for cache_file in self.cache_dir.glob("*.pth"):
+                with contextlib.suppress(FileNotFoundError):
+                    stat = cache_file.stat()
+                    files.append((stat.st_mtime_ns, stat.st_size, cache_file))
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            if total > self.max_disk_bytes:
+                for _, size, cache_file in sorted(files, key=lambda entry: entry[0]):
+                    if total <= self.max_disk_bytes * 0.9:
+                        break
+                    cache_file.unlink(missing_ok=True)
+                    total -= size
+                    removed += 1
+            with self.lock:
+                self.disk_bytes = total
+                self.pruned += removed
+            if removed:
+                print(f"[{params['branding']}Cache] \033[94mLatent cache pruned\033[0m {removed} files, \033[93m{total / 1024 / 1024:.1f} MB\033[0m kept")
+        finally:
+            self.prune_lock.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+                "pruned_files": self.pruned,
+                "precision": self.precision,
+            }
+
+    def _remember(self, key, latents):
+        with self.lock:
+            self.entries[key] = latents
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+speaker_latent_cache = SpeakerLatentCache(
+    this_dir / params.get("speaker_latent_cache_folder", "latent_cache"),
+    params.get("speaker_latent_cache_size", 64),
+    float(params.get("speaker_latent_cache_mb", 256)) * 1024 * 1024,
+    params.get("voice_store_precision", "fp32"),
+)
+
+
+# Cache key of the conditioning latents for a reference wav under the current model settings
+def speaker_latent_key(audio_path):
+    return speaker_latent_cache.make_key(
+        audio_path, model.config.gpt_cond_len, model.config.max_ref_len, model.config.sound_norm_refs
+    )
+
+
+# Return the conditioning latents for a reference wav, computing them only on a cache miss
+def get_speaker_latents(audio_path):
+    return get_speaker_latents_batch([audio_path])[0]
+
+
+# Batch version of get_speaker_latents, all cache misses are extracted together in one pass
+def get_speaker_latents_batch(audio_paths):
+    keys = [speaker_latent_key(audio_path) for audio_path in audio_paths]
+    results = [speaker_latent_cache.get(key) for key in keys]
+    missing = [index for index, latents in enumerate(results) if latents is None]
+    if missing:
+        extracted = extract_conditioning_batch(
+            [audio_paths[index] for index in missing],
+            gpt_cond_len=model.config.gpt_cond_len,
+            max_ref_length=model.config.max_ref_len,
+            sound_norm_refs=model.config.sound_norm_refs,
+        )
+        for index, (gpt_cond_latent, speaker_embedding) in zip(missing, extracted):
+            results[index] = speaker_latent_cache.put(keys[index], gpt_cond_latent, speaker_embedding)
+    return [(latents[0].to(device), latents[1].to(device)) for latents in results]
+
+
+##############################
+#### BATCHED CONDITIONING ####
+##############################
+class ReferenceAudioCache:
+    """
+    Byte bounded LRU of decoded reference audio and the mel spectrogram chunks made from it, keyed by
+    the file's SHA-256 and the target sample rate (plus the cut and normalisation settings that shape
+    the stored tensor). Recomputing conditioning after a latent cache eviction, or under a different
+    gpt_cond_len, then skips reading, decoding and resampling the wav.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        tensors = value if isinstance(value, list) else [value]
+        size = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+        if size > self.max_bytes:
+            return value
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.entries.popitem(last=False)[1][1]
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+reference_audio_cache = ReferenceAudioCache(float(params.get("reference_audio_cache_mb", 256)) * 1024 * 1024)
+
+
+# Reference audio at load_sr, cut to max_ref_length and optionally loudness normalised, as get_conditioning_latents prepares it
+def load_reference_audio(audio_path, digest, load_sr, max_ref_length, sound_norm_refs):
+    key = ("audio", digest, load_sr, max_ref_length, bool(sound_norm_refs))
+    audio = reference_audio_cache.get(key)
+    if audio is None:
+        decoded = reference_audio_cache.get(("decoded", digest, load_sr))
+        if decoded is None:
+            decoded = reference_audio_cache.put(("decoded", digest, load_sr), load_audio(str(audio_path), load_sr))
+        audio = decoded[:, : load_sr * max_ref_length]
+        if sound_norm_refs:
+            audio = (audio / torch.abs(audio).max()) * 0.75
+        audio = reference_audio_cache.put(key, audio)
+    return audio
+
+
+# The speaker encoder (an SE-ResNet with attentive statistics pooling) sees a whole clip at once, so clips of different
+# lengths cannot simply be zero padded into one batch: the padding would leak into the convolutions at each clip's
+# end, the squeeze-excitation means and the attention pooling. Instead the spectrogram and its instance norm are made
+# per clip, and while the padded batch runs through the network every convolution input is zeroed past each clip's
+# length at that layer's resolution (which is exactly the zero padding the convolution applies to a single clip), the
+# squeeze-excitation means only count the valid frames and the attention softmax gives padded frames no weight. The
+# first padded batch is checked against per clip passes, and any mismatch switches back to per length groups.
+speaker_batching = {"padded": None, "max_difference": None}
+SPEAKER_ENCODER_PARTS = ("torch_spec", "instancenorm", "conv1", "relu", "bn1", "layer1", "layer2", "layer3", "layer4", "attention", "fc", "encoder_type")
+
+
+@contextlib.contextmanager
+def mask_padded_frames(encoder, lengths, padded_length):
+    def valid_frames(time_steps, device):
+        ratio = 2 ** round(math.log2(padded_length / time_steps))
+        valid = torch.tensor([math.ceil(length / ratio) for length in lengths], device=device)
+        return torch.arange(time_steps, device=device)[None, :] < valid[:, None]
+
+    def zero_padding(module, inputs):
+        x = inputs[0]
+        return (x * valid_frames(x.shape[-1], x.device)[:, None, None, :].to(x.dtype),) + inputs[1:]
+
+    def masked_mean(module, inputs, output):
+        x = inputs[0]
+        mask = valid_frames(x.shape[-1], x.device)[:, None, None, :].to(x.dtype)
+        return (x * mask).sum(dim=(2, 3), keepdim=True) / (mask.sum(dim=(2, 3), keepdim=True) * x.shape[2])
+
+    def masked_softmax(module, inputs):
+        x = inputs[0]
+        return (x.masked_fill(~valid_frames(x.shape[-1], x.device)[:, None, :], float("-inf")),)
+
+    handles = []
+    for module in encoder.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            handles.append(module.register_forward_pre_hook(zero_padding))
+        elif isinstance(module, torch.nn.AdaptiveAvgPool2d):
+            handles.append(module.register_forward_hook(masked_mean))
+    for module in encoder.attention.modules():
+        if isinstance(module, torch.nn.Softmax):
+            handles.append(module.register_forward_pre_hook(masked_softmax))
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+# ResNetSpeakerEncoder.forward over clips of any length in one pass
+def speaker_encoder_padded(encoder, audios_16k):
+    specs = []
+    for audio_16k in audios_16k:
+        x = audio_16k.to(model.device)
+        if encoder.use_torch_spec:
+            x = encoder.torch_spec(x)
+        if encoder.log_input:
+            x = (x + 1e-6).log()
+        specs.append(encoder.instancenorm(x))
+    lengths = [spec.shape[-1] for spec in specs]
+    padded_length = max(lengths)
+    x = torch.cat([torch.nn.functional.pad(spec, (0, padded_length - spec.shape[-1])) for spec in specs]).unsqueeze(1)
+    with mask_padded_frames(encoder, lengths, padded_length):
+        x = encoder.bn1(encoder.relu(encoder.conv1(x)))
+        x = encoder.layer4(encoder.layer3(encoder.layer2(encoder.layer1(x))))
+        x = x.reshape(x.size()[0], -1, x.size()[-1])
+        w = encoder.attention(x)
+    if encoder.encoder_type == "SAP":
+        x = torch.sum(x * w, dim=2)
+    else:
+        mu = torch.sum(x * w, dim=2)
+        sg = torch.sqrt((torch.sum((x**2) * w, dim=2) - mu**2).clamp(min=1e-5))
+        x = torch.cat((mu, sg), 1)
+    x = encoder.fc(x.view(x.size()[0], -1))
+    return torch.nn.functional.normalize(x, p=2, dim=1)
+
+
+def speaker_embeddings_batch(audios_16k):
+    encoder = model.hifigan_decoder.speaker_encoder
+    if speaker_batching["padded"] is None:
+        speaker_batching["padded"] = all(hasattr(encoder, part) for part in SPEAKER_ENCODER_PARTS)
+    if speaker_batching["padded"] and len({audio_16k.shape[-1] for audio_16k in audios_16k}) > 1:
+        embeddings = speaker_encoder_padded(encoder, audios_16k)
+        if speaker_batching["max_difference"] is None:
+            reference = torch.cat([encoder.forward(audio_16k.to(model.device), l2_norm=True) for audio_16k in audios_16k])
+            speaker_batching["max_difference"] = (embeddings - reference).abs().max().item()
+            if speaker_batching["max_difference"] > 1e-4:
+                speaker_batching["padded"] = False
+                print(
+                    f"[{params['branding']}Model] \033[91mWarning\033[0m Padded speaker encoder batches differ from single clips by "
+                    f"{speaker_batching['max_difference']:.2e}, batching equal lengths only"
+                )
+                return reference
+        return embeddings
+    # One forward pass per distinct clip length
+    embeddings = [None] * len(audios_16k)
+    for indexes in _group_by_length([audio_16k.shape[-1] for audio_16k in audios_16k]):
+        group = encoder.forward(torch.cat([audios_16k[index] for index in indexes], dim=0).to(model.device), l2_norm=True)
+        for row, index in enumerate(indexes):
+            embeddings[index] = group[row]
+    return torch.stack(embeddings)
+
+
+# Same result as model.get_conditioning_latents on each clip on its own, but the speaker encoder runs once for all
+# clips (see above), and the mel frontend and the GPT conditioning encoder once per group of equally sized inputs.
+# Those groups stay unpadded as padding changes the conditioning encoder's output, but its inputs are the fixed
+# gpt_cond_chunk_len chunks, so nearly all of them share one length anyway.
+@torch.inference_mode()
+def extract_conditioning_batch(audio_paths, gpt_cond_len, max_ref_length, sound_norm_refs, gpt_cond_chunk_len=6):
+    load_sr = 22050
+    digests = [speaker_latent_cache.file_digest(audio_path) for audio_path in audio_paths]
+    audios = [
+        load_reference_audio(audio_path, digest, load_sr, max_ref_length, sound_norm_refs)
+        for audio_path, digest in zip(audio_paths, digests)
+    ]
+
+    # Speaker encoder, one forward pass for all clips
+    audios_16k = []
+    for audio, digest in zip(audios, digests):
+        key = ("audio", digest, 16000, max_ref_length, bool(sound_norm_refs))
+        audio_16k = reference_audio_cache.get(key)
+        if audio_16k is None:
+            audio_16k = reference_audio_cache.put(key, torchaudio.functional.resample(audio, load_sr, 16000))
+        audios_16k.append(audio_16k)
+    embeddings = speaker_embeddings_batch(audios_16k)
+    speaker_embeddings = [embeddings[row : row + 1].unsqueeze(-1) for row in range(len(audios_16k))]
+
+    if not model.args.gpt_use_perceiver_resampler:
+        return [
+            (model.get_gpt_cond_latents(audio.to(model.device), load_sr, length=gpt_cond_len, chunk_length=gpt_cond_chunk_len), speaker_embedding)
+            for audio, speaker_embedding in zip(audios, speaker_embeddings)
+        ]
+
+    # Mel chunks per clip, from the cache or cut from the audio and computed together for all clips
+    chunk_samples = load_sr * gpt_cond_chunk_len
+    mel_keys = [("mel", digest, load_sr, max_ref_length, bool(sound_norm_refs), gpt_cond_len, gpt_cond_chunk_len) for digest in digests]
+    clip_mels = [reference_audio_cache.get(mel_key) for mel_key in mel_keys]
+    chunks = []
+    owners = []
+    for index, audio in enumerate(audios):
+        if clip_mels[index] is not None:
+            continue
+        clip_mels[index] = []
+        audio = audio[:, : load_sr * gpt_cond_len] if gpt_cond_len > 0 else audio
+        for start in range(0, audio.shape[1], chunk_samples):
+            audio_chunk = audio[:, start : start + chunk_samples]
+            # Chunks that are too short are ignored, as in Xtts.get_gpt_cond_latents
+            if audio_chunk.size(-1) < load_sr * 0.33:
+                continue
+            chunks.append(audio_chunk)
+            owners.append(index)
+    computed_mels = [None] * len(chunks)
+    for indexes in _group_by_length([audio_chunk.shape[-1] for audio_chunk in chunks]):
+        mel_chunks = wav_to_mel_cloning(
+            torch.cat([chunks[index] for index in indexes], dim=0).to(model.device),
+            mel_norms=model.mel_stats.cpu(),
+            n_fft=2048,
+            hop_length=256,
+            win_length=1024,
+            power=2,
+            normalized=False,
+            sample_rate=load_sr,
+            f_min=0,
+            f_max=8000,
+            n_mels=80,
+        )
+        for row, index in enumerate(indexes):
+            computed_mels[index] = mel_chunks[row : row + 1].cpu()
+    for mel_chunk, owner in zip(computed_mels, owners):
+        clip_mels[owner].append(mel_chunk)
+    for index in set(owners):
+        reference_audio_cache.put(mel_keys[index], clip_mels[index])
+
+    # GPT conditioning encoder, one forward pass per distinct mel length
+    mels = [mel_chunk for mel_chunks in clip_mels for mel_chunk in mel_chunks]
+    mel_owners = [index for index, mel_chunks in enumerate(clip_mels) for _ in mel_chunks]
+    style_embs = [None] * len(mels)
+    for indexes in _group_by_length([mel_chunk.shape[-1] for mel_chunk in mels]):
+        embs = model.gpt.get_style_emb(torch.cat([mels[index] for index in indexes], dim=0).to(model.device), None)
+        for row, index in enumerate(indexes):
+            style_embs[index] = embs[row : row + 1]
+    results = []
+    for index, speaker_embedding in enumerate(speaker_embeddings):
+        voice_embs = [style_emb for style_emb, owner in zip(style_embs, mel_owners) if owner == index]
+        if not voice_embs:
+            raise ValueError(f"Reference audio {audio_paths[index]} is too short to compute conditioning latents.")
+        gpt_cond_latent = torch.stack(voice_embs).mean(dim=0).transpose(1, 2)
+        results.append((gpt_cond_latent, speaker_embedding))
+    return results
+
+
+def _group_by_length(lengths):
+    groups = {}
+    for index, length in enumerate(lengths):
+        groups.setdefault(length, []).append(index)
+    return list(groups.values())
+
+
+@app.get("/api/latentcache")
+async def latent_cache_status():
+    return {**speaker_latent_cache.stats(), "reference_audio": reference_audio_cache.stats(), "speaker_batching": speaker_batching}
+
+
+##########################
+#### VOICE PREWARMING ####
+##########################
+class VoicePrewarmer:
+    """
+    Computes speaker latents for every wav in the voices folder on a background worker after the model
+    loads, most used voices first. Requests keep being served while it runs and pick up whatever is
+    already in the speaker latent cache. Usage counts are persisted next to the latent cache.
+    """
+    def __init__(self, usage_path):
+        self.usage_path = Path(usage_path)
+        self.usage = None
+        self.unsaved_uses = 0
+        self.lock = threading.Lock()
+        self.task = None
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.current = None
+        self.started = None
+        self.finished = None
+
+    def record_use(self, voice):
+        with self.lock:
+            usage = self._load_usage()
+            usage[voice] = usage.get(voice, 0) + 1
+            self.unsaved_uses += 1
+            save_now = self.unsaved_uses >= 50
+        if save_now:
+            self.save_usage()
+
+    def save_usage(self):
+        with self.lock:
+            if self.usage is None or self.unsaved_uses == 0:
+                return
+            self.usage_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.usage_path.with_suffix(".tmp")
+            with open(temp_path, "w") as usage_file:
+                json.dump(self.usage, usage_file)
+            os.replace(temp_path, self.usage_path)
+            self.unsaved_uses = 0
+
+    def start(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = asyncio.ensure_future(self.run())
+
+    # Voices to warm, most used first, and how many are cached already. Listing the folder and hashing every wav
+    # to find its cache entry is blocking work, so it runs on a thread rather than on the event loop.
+    def _plan(self):
+        with self.lock:
+            usage = dict(self._load_usage())
+        voices = sorted(list_files(this_dir / "voices"), key=lambda voice: -usage.get(voice, 0))
+        cold_voices = [
+            voice for voice in voices if not speaker_latent_cache.is_cached(speaker_latent_key(this_dir / "voices" / voice))
+        ]
+        return len(voices), cold_voices
+
+    async def run(self):
+        self.reset()
+        self.started = time.time()
+        self.total, cold_voices = await asyncio.to_thread(self._plan)
+        self.done = self.total - len(cold_voices)
+        print(f"[{params['branding']}Model] \033[94mPrewarming\033[0m {len(cold_voices)} of {self.total} voices in the background")
+        batch_size = max(int(params.get("conditioning_batch_size", 8)), 1)
+        for start in range(0, len(cold_voices), batch_size):
+            batch = cold_voices[start : start + batch_size]
+            self.current = batch[0]
+            try:
+                await inference_executor.run(get_speaker_latents_batch, [this_dir / "voices" / voice for voice in batch])
+            except Exception:
+                # Retry one at a time so a single unreadable wav does not fail the whole batch
+                for voice in batch:
+                    self.current = voice
+                    try:
+                        await inference_executor.run(get_speaker_latents, this_dir / "voices" / voice)
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"[{params['branding']}Model] \033[91mWarning\033[0m Could not prewarm {voice}: {e}")
+            self.done += len(batch)
+        self.current = None
+        self.finished = time.time()
+        print(f"[{params['branding']}Model] \033[94mPrewarm complete in \033[93m{self.finished - self.started:.2f} seconds.\033[0m")
+
+    def status(self):
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        remaining = self.total - self.done
+        eta = elapsed / self.done * remaining if self.done and remaining else 0.0
+        return {
+            "enabled": params.get("prewarm_voices", False),
+            "running": self.task is not None and not self.task.done(),
+            "done": self.done,
+            "total": self.total,
+            "failed": self.failed,
+            "current": self.current,
+            "elapsed_seconds": round(elapsed, 2),
+            "eta_seconds": round(eta, 2),
+        }
+
+    def _load_usage(self):
+        if self.usage is None:
+            try:
+                with open(self.usage_path, "r") as usage_file:
+                    self.usage = json.load(usage_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.usage = {}
+        return self.usage
+
+
+voice_prewarmer = VoicePrewarmer(speaker_latent_cache.cache_dir / "usage.json")
+
+
+@app.get("/api/prewarm/status")
+async def prewarm_status():
+    return voice_prewarmer.status()
+
+
+###############################
+#### VOICE EMBEDDING STORE ####
+###############################
+# SAFETENSORS Import - Memory mapped tensor files, falls back to numpy .npz if the package is missing
+safetensors_available = False
+try:
+    from safetensors import safe_open as safetensors_open
+    from safetensors.torch import load_file as safetensors_load_file, save_file as safetensors_save_file
+    safetensors_available = True
+except ImportError:
+    pass
+
+
+# Reduced precision storage for voice conditioning. "fp16" halves the size, "int8" keeps one float32
+# scale per tensor (symmetric, max abs / 127) next to the int8 values and quarters it.
+def quantize_tensor(tensor, precision):
+    tensor = tensor.detach().float().cpu()
+    if precision == "fp16":
+        return tensor.half(), None
+    if precision == "int8":
+        scale = tensor.abs().max().clamp(min=1e-12) / 127.0
+        return torch.round(tensor / scale).clamp(-127, 127).to(torch.int8), scale.reshape(1)
+    return tensor, None
+
+
+def dequantize_tensor(stored, scale):
+    tensor = stored.to(device=device, dtype=torch.float32)
+    if scale is not None:
+        tensor = tensor * scale.to(device)
+    return tensor
+
+
+class VoiceEmbeddingStore:
+    """
+    Stored voices (gpt_cond_latent, speaker_embedding): the characters used by /api/generate_local and
+    voices registered through /api/voices. The store is a base file plus a journal folder next to it.
+    Registering or deleting a voice writes one small shard (the voice's tensors, or a tombstone) to the
+    journal, so a change costs the size of one voice however large the library is. Once the journal
+    holds compact_every shards, a background thread writes a new base file from a snapshot and drops
+    the shards it absorbed; the base records the last shard it contains, so a crash part way through
+    leaves a consistent store. In fp32 the voices are kept as ready device tensors, in fp16/int8 they
+    stay compact in system RAM and the most recently used ones are kept dequantized on the device
+    (hot_size). If the files change on disk, the next lookup loads the new contents and swaps them in
+    as a whole so requests never see a half loaded store. The legacy data.json, which other tools
+    still write, is imported whenever it is newer than the copy the base file records: its voices are
+    added to (or replace same named voices in) the store and a new base is written.
+    """
+    def __init__(self, store_path, legacy_json_path, precision="fp32", hot_size=256, compact_every=256):
+        self.store_path = Path(store_path)
+        self.journal_path = self.store_path.with_name(f"{self.store_path.stem}.journal")
+        self.legacy_json_path = Path(legacy_json_path)
+        if precision not in ("fp32", "fp16", "int8"):
+            print(f"[{params['branding']}Startup] \033[91mWarning\033[0m Unknown voice_store_precision '{precision}', using fp32")
+            precision = "fp32"
+        self.precision = precision
+        self.hot_size = max(int(hot_size), 1)
+        self.compact_every = max(int(compact_every), 1)
+        self.hot = OrderedDict()
+        self.voices = {}
+        self.metadata = {}
+        self.identities = {}
+        self.base_seq = 0
+        self.journal_seq = 0
+        self.compacting = False
+        # Modification time of the data.json last imported
+        self.legacy_imported = 0
+        # (journal_seq, legacy_imported) of the newest base file, base writers never replace it with an older one
+        self.base_version = (0, 0)
+        self.base_lock = threading.Lock()
+        self.file_signature = None
+        # Called as listener(op, voice_name, stored) after each change, op being "add", "remove" or "reset"
+        self.listeners = []
+        self.lock = threading.Lock()
+        # Re-entrant so remove() can check and journal under one hold
+        self.write_lock = threading.RLock()
+
+    def _signature(self):
+        stats = []
+        for path in (self.store_path, self.journal_path, self.legacy_json_path):
+            try:
+                stat = path.stat()
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats) if any(stats) else None
+
+    def _shards(self, after=0):
+        try:
+            shards = [(int(path.stem), path) for path in self.journal_path.iterdir() if path.stem.isdigit() and path.suffix == self.store_path.suffix]
+        except FileNotFoundError:
+            return []
+        return sorted(shard for shard in shards if shard[0] > after)
+
+    # Under the write lock, so a shard journaled while the files are read is never lost from memory
+    def load(self):
+        with self.write_lock:
+            self._load()
+
+    def _load(self):
+        signature = self._signature()
+        voices, metadata, base_seq, legacy_imported = {}, {}, 0, 0
+        if self.store_path.exists():
+            tensors, header = self._read_tensors(self.store_path)
+            voices = self._parse(tensors)
+            metadata = json.loads(header.get("voices", "{}"))
+            base_seq = int(header.get("journal_seq", 0))
+            legacy_imported = int(header.get("legacy_json_mtime", 0))
+        journal_seq = base_seq
+        for journal_seq, shard_path in self._shards(after=base_seq):
+            tensors, header = self._read_tensors(shard_path)
+            voice_name = header["voice"]
+            if header["op"] == "remove":
+                voices.pop(voice_name, None)
+                metadata.pop(voice_name, None)
+            elif voice_name in (shard := self._parse(tensors)):
+                voices[voice_name] = shard[voice_name]
+                metadata[voice_name] = json.loads(header.get("metadata", "{}"))
+        try:
+            legacy_mtime = self.legacy_json_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            legacy_mtime = 0
+        if legacy_mtime > legacy_imported:
+            try:
+                voices.update(self.migrate_from_json())
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"[{params['branding']}Model] \033[91mWarning\033[0m Could not import {self.legacy_json_path.name}, it is not in use: {e}")
+            else:
+                metadata = {voice_name: metadata.get(voice_name, {}) for voice_name in voices}
+                self._write_base(voices, metadata, journal_seq, legacy_mtime)
+                base_seq, legacy_imported = journal_seq, legacy_mtime
+                signature = self._signature()
+        with self.lock:
+            self.voices = voices
+            self.metadata = metadata
+            self.hot = OrderedDict()
+            self.identities = {}
+            self.base_seq = base_seq
+            self.journal_seq = journal_seq
+            self.legacy_imported = legacy_imported
+            self.file_signature = signature
+        with self.base_lock:
+            self.base_version = max(self.base_version, (base_seq, legacy_imported))
+        for listener in self.listeners:
+            listener("reset", None, None)
+        if signature is not None:
+            print(f"[{params['branding']}Model] \033[94mVoice store loaded\033[0m {len(voices)} voices from \033[93m{self.store_path.name}\033[0m")
+
+    # Stored fields per voice from a flat {"voice::field": tensor} mapping
+    def _parse(self, tensors):
+        voices = {}
+        for tensor_name, tensor in tensors.items():
+            voice_name, _, field = tensor_name.rpartition("::")
+            # Full precision tensors go straight to the device, compact ones stay in system RAM
+            voices.setdefault(voice_name, {})[field] = tensor.to(device) if tensor.dtype == torch.float32 and "." not in field else tensor
+        return {
+            voice_name: (
+                (fields["gpt_cond_latent"], fields.get("gpt_cond_latent.scale")),
+                (fields["speaker_embedding"], fields.get("speaker_embedding.scale")),
+            )
+            for voice_name, fields in voices.items()
+            if "gpt_cond_latent" in fields and "speaker_embedding" in fields
+        }
+
+    def reload_if_changed(self):
+        if self._signature() != self.file_signature:
+            self.load()
+
+    def has(self, voice_name):
+        self.reload_if_changed()
+        with self.lock:
+            return voice_name in self.voices
+
+    def get(self, voice_name):
+        self.reload_if_changed()
+        with self.lock:
+            stored = self.voices.get(voice_name)
+            hot = self.hot.get(voice_name)
+            if hot is not None:
+                self.hot.move_to_end(voice_name)
+        if stored is None:
+            raise ValueError(f"Voice '{voice_name}' is not in the voice embedding store.")
+        if hot is None:
+            hot = (dequantize_tensor(*stored[0]), dequantize_tensor(*stored[1]))
+            if stored[0][0].dtype != torch.float32:
+                with self.lock:
+                    self.hot[voice_name] = hot
+                    while len(self.hot) > self.hot_size:
+                        self.hot.popitem(last=False)
+        return hot[0].to(device), hot[1].to(device)
+
+    def get_many(self, voice_names):
+        return [self.get(voice_name) for voice_name in voice_names]
+
+    def describe(self, voice_name):
+        self.reload_if_changed()
+        with self.lock:
+            stored = self.voices.get(voice_name)
+            metadata = dict(self.metadata.get(voice_name, {}))
+        if stored is None:
+            return None
+        return {
+            "voice_id": voice_name,
+            **metadata,
+            "gpt_cond_latent_shape": list(stored[0][0].shape),
+            "speaker_embedding_shape": list(stored[1][0].shape),
+            "storage_dtype": str(stored[0][0].dtype).replace("torch.", ""),
+        }
+
+    # Identity of one stored voice's contents, used to key blends and results, so changing one voice leaves the
+    # cached output of every other voice valid
+    def identity(self, voice_name):
+        self.reload_if_changed()
+        with self.lock:
+            identity = self.identities.get(voice_name)
+            stored = self.voices.get(voice_name)
+        if identity is None and stored is not None:
+            digest = hashlib.sha256()
+            for tensor, scale in stored:
+                digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+                if scale is not None:
+                    digest.update(scale.detach().cpu().numpy().tobytes())
+            identity = digest.hexdigest()[:16]
+            with self.lock:
+                self.identities[voice_name] = identity
+        return f"store:{identity}:{voice_name}"
+
+    def names(self):
+        with self.lock:
+            return list(self.voices)
+
+    # All speaker embeddings as one float32 numpy matrix (one row per voice) for the similarity index
+    def speaker_embedding_matrix(self):
+        self.reload_if_changed()
+        with self.lock:
+            voices = dict(self.voices)
+        names = list(voices)
+        matrix = np.zeros((len(names), 0), dtype=np.float32)
+        if names:
+            matrix = np.stack([self.embedding_row(voices[name]) for name in names])
+        return names, matrix
+
+    @staticmethod
+    def embedding_row(stored):
+        speaker_embedding, scale = stored[1]
+        return (speaker_embedding.detach().float().cpu() * (scale if scale is not None else 1.0)).reshape(-1).numpy()
+
+    # Add or replace one voice, journaled as a single shard
+    def add(self, voice_name, gpt_cond_latent, speaker_embedding, metadata=None):
+        self._append("add", voice_name, (self._encode(gpt_cond_latent), self._encode(speaker_embedding)), metadata or {})
+
+    def remove(self, voice_name):
+        with self.write_lock:
+            self.reload_if_changed()
+            with self.lock:
+                if voice_name not in self.voices:
+                    return False
+            self._append("remove", voice_name)
+            return True
+
+    def _append(self, op, voice_name, stored=None, metadata=None):
+        with self.write_lock:
+            self.reload_if_changed()
+            seq = self.journal_seq + 1
+            self.journal_path.mkdir(parents=True, exist_ok=True)
+            header = {"op": op, "voice": voice_name, "metadata": json.dumps(metadata or {})}
+            tensors = self._flatten({voice_name: stored}) if stored is not None else {}
+            self._write_tensors(self.journal_path / f"{seq:012d}{self.store_path.suffix}", tensors, header)
+            with self.lock:
+                voices = dict(self.voices)
+                all_metadata = dict(self.metadata)
+                if stored is None:
+                    voices.pop(voice_name, None)
+                    all_metadata.pop(voice_name, None)
+                else:
+                    voices[voice_name] = stored
+                    all_metadata[voice_name] = metadata
+                self.voices = voices
+                self.metadata = all_metadata
+                self.hot.pop(voice_name, None)
+                self.identities.pop(voice_name, None)
+                self.journal_seq = seq
+                self.file_signature = self._signature()
+                compact = seq - self.base_seq >= self.compact_every and not self.compacting
+                if compact:
+                    self.compacting = True
+            for listener in self.listeners:
+                listener(op, voice_name, stored)
+        if compact:
+            threading.Thread(target=self.compact, name="alltalk-voice-store-compaction", daemon=True).start()
+
+    # Folds the journal into a new base file. Only the snapshot is taken under the write lock; the long write
+    # happens while registrations carry on appending shards after it.
+    def compact(self):
+        try:
+            with self.write_lock:
+                with self.lock:
+                    voices = dict(self.voices)
+                    all_metadata = dict(self.metadata)
+                    seq = self.journal_seq
+                    legacy_imported = self.legacy_imported
+            self._write_base(voices, all_metadata, seq, legacy_imported)
+            with self.write_lock:
+                with self.lock:
+                    self.base_seq = max(self.base_seq, seq)
+                    self.file_signature = self._signature()
+            print(f"[{params['branding']}Model] \033[94mVoice store compacted\033[0m {len(voices)} voices")
+        except Exception as e:
+            print(f"[{params['branding']}Model] \033[91mWarning\033[0m Voice store compaction failed: {e}")
+        finally:
+            self.compacting = False
+
+    # Voices in data.json, encoded for the store
+    def migrate_from_json(self):
+        print(f"[{params['branding']}Model] \033[94mImporting\033[0m {self.legacy_json_path.name} \033[94minto\033[0m {self.store_path.name}")
+        with open(self.legacy_json_path, "r") as legacy_file:
+            information = json.load(legacy_file)
+        return {
+            voice_name: (
+                self._encode(torch.tensor(fields["gpt_cond_latent"], dtype=torch.float32)),
+                self._encode(torch.tensor(fields["speaker_embedding"], dtype=torch.float32)),
+            )
+            for voice_name, fields in information.items()
+        }
+
+    # New base file holding everything up to journal shard seq, then the shards it absorbed are dropped. A compaction
+    # that finishes after a data.json import wrote a newer base leaves that one in place.
+    def _write_base(self, voices, all_metadata, seq, legacy_imported):
+        with self.base_lock:
+            if (seq, legacy_imported) < self.base_version:
+                return
+            header = {"voices": json.dumps(all_metadata), "journal_seq": str(seq), "legacy_json_mtime": str(legacy_imported)}
+            self._write_tensors(self.store_path, self._flatten(voices), header)
+            self.base_version = (seq, legacy_imported)
+            for shard_seq, shard_path in self._shards():
+                if shard_seq <= seq:
+                    shard_path.unlink(missing_ok=True)
+
+    def _encode(self, tensor):
+        stored, scale = quantize_tensor(tensor, self.precision)
+        return (stored.to(device), scale) if self.precision == "fp32" else (stored, scale)
+
+    @staticmethod
+    def _flatten(voices):
+        tensors = {}
+        for voice_name, stored_fields in voices.items():
+            for field, (stored, scale) in zip(("gpt_cond_latent", "speaker_embedding"), stored_fields):
+                tensors[f"{voice_name}::{field}"] = stored.cpu()
+                if scale is not None:
+                    tensors[f"{voice_name}::{field}.scale"] = scale.cpu()
+        return tensors
+
+    # Tensors and the string header of a base file or journal shard
+    def _read_tensors(self, path):
+        if path.suffix == ".safetensors":
+            with safetensors_open(str(path), framework="pt") as stored:
+                header = dict(stored.metadata() or {})
+            return safetensors_load_file(str(path), device="cpu"), header
+        with np.load(path) as stored:
+            if "__header__" in stored.files:
+                header = json.loads(str(stored["__header__"]))
+            else:
+                # Stores written before the journal kept only the voice metadata
+                header = {"voices": str(stored["__metadata__"])} if "__metadata__" in stored.files else {}
+            tensors = {tensor_name: torch.from_numpy(stored[tensor_name]) for tensor_name in stored.files if not tensor_name.startswith("__")}
+        return tensors, header
+
+    def _write_tensors(self, path, tensors, header):
+        # Write next to the target and rename over it so readers only ever see a complete file
+        temp_path = path.with_name(f"{path.stem}.tmp{path.suffix}")
+        if path.suffix == ".safetensors":
+            safetensors_save_file({name: tensor.contiguous() for name, tensor in tensors.items()}, str(temp_path), metadata=header)
+        else:
+            with open(temp_path, "wb") as temp_file:
+                np.savez(temp_file, __header__=np.array(json.dumps(header)), **{name: tensor.numpy() for name, tensor in tensors.items()})
+        os.replace(temp_path, path)
+
+
+voice_embedding_store = VoiceEmbeddingStore(
+    this_dir / params.get("voice_store_file", "voices.safetensors" if safetensors_available else "voices.npz"),
+    this_dir / "data.json",
+    precision=params.get("voice_store_precision", "fp32"),
+    hot_size=params.get("voice_store_hot_size", 256),
+    compact_every=params.get("voice_store_compact_every", 256),
+)
+
+
+################################
+#### VOICE SIMILARITY INDEX ####
+################################
+class VoiceSimilarityIndex:
+    """
+    Cosine similarity search over the speaker embeddings in the voice embedding store. Embeddings are
+    kept as one L2 normalised NumPy matrix, so a query is a single matrix-vector product. Libraries of
+    at least ivf_threshold voices also get a coarse quantizer (spherical k-means, about sqrt(n) lists)
+    and a query only scores the members of the nprobe closest lists. The matrix is built once and then
+    follows the store change by change: an added voice is appended and assigned to its closest list, a
+    removed one is swapped out with the last row. K-means runs on a background thread, when the library
+    first crosses the threshold and again whenever it has doubled or halved since the last training;
+    searches use the previous lists (or score every voice) until it finishes.
+    """
+    def __init__(self, ivf_threshold=20000, nprobe=8):
+        self.ivf_threshold = int(ivf_threshold)
+        self.nprobe = max(int(nprobe), 1)
+        self.built = False
+        self.generation = 0
+        self.names = []
+        self.positions = {}
+        self.count = 0
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.centroids = None
+        self.lists = None
+        self.assignment = None
+        self.trained_count = 0
+        self.training = False
+        self.lock = threading.Lock()
+        voice_embedding_store.listeners.append(self.on_store_change)
+
+    def refresh(self):
+        voice_embedding_store.reload_if_changed()
+        while True:
+            with self.lock:
+                if self.built:
+                    return
+                generation = self.generation
+            names, matrix = voice_embedding_store.speaker_embedding_matrix()
+            matrix = self.normalize(matrix)
+            with self.lock:
+                # A change landed while the matrix was being read, so read it again
+                if generation != self.generation:
+                    continue
+                self.names = names
+                self.positions = {name: position for position, name in enumerate(names)}
+                self.count = len(names)
+                self.matrix = matrix
+                self.centroids = None
+                self.lists = None
+                self.assignment = None
+                self.trained_count = 0
+                self.built = True
+                self._schedule_training()
+                return
+
+    # Store listener: keeps the matrix and list assignment in step with each add or remove
+    def on_store_change(self, op, voice_name, stored):
+        with self.lock:
+            self.generation += 1
+            if op == "reset":
+                self.built = False
+            if not self.built:
+                return
+            if op == "add":
+                self._put(voice_name, self.normalize(VoiceEmbeddingStore.embedding_row(stored)))
+            elif op == "remove" and voice_name in self.positions:
+                self._delete(voice_name)
+            self._schedule_training()
+
+    def _put(self, voice_name, vector):
+        position = self.positions.get(voice_name)
+        if position is None:
+            position = self.count
+            if self.count == len(self.matrix) or self.matrix.shape[1] != len(vector):
+                # Grow by doubling so appends stay amortised constant time
+                grown = np.zeros((max(2 * len(self.matrix), 16), len(vector)), dtype=np.float32)
+                grown[: self.count] = self.matrix[: self.count]
+                self.matrix = grown
+                if self.assignment is not None:
+                    self.assignment = np.concatenate((self.assignment, np.zeros(len(grown) - len(self.assignment), dtype=self.assignment.dtype)))
+            self.names.append(voice_name)
+            self.positions[voice_name] = position
+            self.count += 1
+        elif self.lists is not None:
+            self._unlist(position)
+        self.matrix[position] = vector
+        if self.lists is not None:
+            nearest = int(np.argmax(self.centroids @ vector))
+            self.assignment[position] = nearest
+            self.lists[nearest] = np.append(self.lists[nearest], position)
+
+    def _delete(self, voice_name):
+        position = self.positions.pop(voice_name)
+        last = self.count - 1
+        if self.lists is not None:
+            self._unlist(position)
+        if position != last:
+            # Move the last row into the gap so the live rows stay contiguous
+            moved = self.names[last]
+            self.matrix[position] = self.matrix[last]
+            self.names[position] = moved
+            self.positions[moved] = position
+            if self.lists is not None:
+                members = self.lists[self.assignment[last]]
+                members[members == last] = position
+                self.assignment[position] = self.assignment[last]
+        self.names.pop()
+        self.count -= 1
+
+    def _unlist(self, position):
+        members = self.lists[self.assignment[position]]
+        self.lists[self.assignment[position]] = members[members != position]
+
+    def _schedule_training(self):
+        if self.training or self.count < self.ivf_threshold:
+            if self.count < self.ivf_threshold:
+                self.centroids = None
+                self.lists = None
+                self.assignment = None
+                self.trained_count = 0
+            return
+        if self.centroids is not None and self.trained_count // 2 <= self.count <= self.trained_count * 2:
+            return
+        self.training = True
+        threading.Thread(target=self._train, name="alltalk-similarity-training", daemon=True).start()
+
+    # Trains the coarse quantizer on a snapshot. If the library changed meanwhile the snapshot is taken again,
+    # and after a few tries the assignment is computed under the lock instead.
+    def _train(self):
+        try:
+            for attempt in range(3):
+                with self.lock:
+                    generation = self.generation
+                    matrix = self.matrix[: self.count].copy()
+                if len(matrix) < self.ivf_threshold:
+                    return
+                centroids = self._train_coarse_quantizer(matrix, int(np.sqrt(len(matrix))))
+                assignment = np.argmax(matrix @ centroids.T, axis=1)
+                with self.lock:
+                    if generation != self.generation and attempt < 2:
+                        continue
+                    if generation != self.generation:
+                        assignment = np.argmax(self.matrix[: self.count] @ centroids.T, axis=1)
+                    self._install(centroids, assignment)
+                    return
+        except Exception as e:
+            print(f"[{params['branding']}Model] \033[91mWarning\033[0m Similarity index training failed: {e}")
+        finally:
+            with self.lock:
+                self.training = False
+
+    def _install(self, centroids, assignment):
+        order = np.argsort(assignment, kind="stable")
+        boundaries = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+        self.centroids = centroids
+        self.lists = [order[boundaries[i] : boundaries[i + 1]] for i in range(len(centroids))]
+        self.assignment = np.zeros(len(self.matrix), dtype=np.int64)
+        self.assignment[: len(assignment)] = assignment
+        self.trained_count = self.count
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def search(self, embedding, k=10, exclude=None):
+        self.refresh()
+        query = self.normalize(np.asarray(embedding, dtype=np.float32).reshape(-1))
+        with self.lock:
+            if not self.count:
+                return []
+            if self.lists is not None:
+                probes = np.argsort(-(self.centroids @ query))[: self.nprobe]
+                candidates = np.concatenate([self.lists[probe] for probe in probes])
+            else:
+                candidates = np.arange(self.count)
+            scores = self.matrix[candidates] @ query
+            candidate_names = [self.names[candidate] for candidate in candidates]
+        count = min(k + (1 if exclude is not None else 0), len(candidates))
+        if count == 0:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count] if count < len(candidates) else np.arange(len(candidates))
+        top = top[np.argsort(-scores[top])]
+        results = [
+            {"voice_id": candidate_names[index], "similarity": round(float(scores[index]), 6)}
+            for index in top
+            if candidate_names[index] != exclude
+        ]
+        return results[:k]
+
+    def embedding_of(self, voice_id):
+        self.refresh()
+        with self.lock:
+            position = self.positions.get(voice_id)
+            return None if position is None else self.matrix[position].copy()
+
+    @staticmethod
+    def _train_coarse_quantizer(matrix, nlist, iterations=10, sample_size=50000):
+        rng = np.random.default_rng(0)
+        sample = matrix[rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=nlist)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            filled = counts > 0
+            sums = np.add.reduceat(sample[order], starts[filled], axis=0)
+            centroids[filled] = VoiceSimilarityIndex.normalize(sums)
+        return centroids
+
+
+voice_similarity_index = VoiceSimilarityIndex(
+    ivf_threshold=params.get("similarity_ivf_threshold", 20000),
+    nprobe=params.get("similarity_nprobe", 8),
+)
+
+
+#####################
+#### BLEND CACHE ####
+#####################
+class BlendCache:
+    """
+    LRU cache of weighted multi-voice blends. The key is the (voice identity, weight) pairs sorted by
+    identity, so the same mix requested in a different order is a hit. Voice identities must change
+    whenever the underlying conditioning changes (the latent cache key, or the voice store signature).
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max(int(max_entries), 1)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(voice_ids, weights):
+        return tuple(sorted((str(voice_id), round(float(weight), 6)) for voice_id, weight in zip(voice_ids, weights)))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, key, gpt_cond_latent, speaker_embedding):
+        with self.lock:
+            self.entries[key] = (gpt_cond_latent, speaker_embedding)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+blend_cache = BlendCache(params.get("blend_cache_size", 32))
+
+
+# Weighted average of several voices' conditioning, served from the blend cache when the same mix was used before
+def get_blended_latents(voices, weights, voice_identity, load_latents_batch):
+    key = blend_cache.make_key([voice_identity(voice) for voice in voices], weights)
+    blended = blend_cache.get(key)
+    if blended is None:
+        gpt_cond_latents = []
+        speaker_embeddings = []
+        for gpt_cond_latent, speaker_embedding in load_latents_batch(voices):
+            gpt_cond_latents.append(gpt_cond_latent)
+            speaker_embeddings.append(speaker_embedding)
+        weighted_speaker_embeddings = [speaker_embedding * weight for speaker_embedding, weight in zip(speaker_embeddings, weights)]
+        weighted_gpt_cond_latents = [gpt_cond_latent * weight for gpt_cond_latent, weight in zip(gpt_cond_latents, weights)]
+        blended = (
+            torch.mean(torch.stack(weighted_gpt_cond_latents), dim=0),
+            torch.mean(torch.stack(weighted_speaker_embeddings), dim=0),
+        )
+        blend_cache.put(key, *blended)
+    return blended[0].to(device), blended[1].to(device)
+
+
+@app.get("/api/blendcache")
+async def blend_cache_status():
+    return blend_cache.stats()
+
+
+# Voices are either IDs in the voice embedding store or paths to reference wavs
+def voice_identity(voice):
+    if voice_embedding_store.has(voice):
+        return voice_embedding_store.identity(voice)
+    return speaker_latent_key(voice)
+
+
+def load_voice_latents_batch(voices):
+    results = [voice_embedding_store.get(voice) if voice_embedding_store.has(voice) else None for voice in voices]
+    missing = [index for index, latents in enumerate(results) if latents is None]
+    for index, latents in zip(missing, get_speaker_latents_batch([voices[index] for index in missing])):
+        results[index] = latents
+    return results
+
+
+######################
+#### CPU TOPOLOGY ####
+######################
+# Left alone, torch sizes its thread pool to every core in the machine for each worker, Whisper does the same, and the
+# ffmpeg processes pydub starts land wherever the scheduler puts them, so under concurrent load they all fight over
+# the same cores. With cpu_topology on, the cores this process may use are split up once at startup:
+#   - audio_encoding_cores are kept apart for writing and encoding finished audio (ffmpeg inherits the pinning)
+#   - the rest go to inference, one core set per worker thread or worker process, with torch threads to match
+#   - on multi-socket hosts a worker process never spans NUMA nodes, and processes are spread across the nodes
+# whisper_threads caps the intra-op threads used for transcription, which is short and would otherwise claim every
+# inference core. Pinning needs os.sched_setaffinity (Linux). Elsewhere only the thread counts are applied.
+# Trade-off: torch's thread count is process wide, so the cap can only be swapped in around a transcription while
+# nothing else is generating. That is why transcription runs as a job on the single inference worker, which means
+# /api/transcribe waits behind any TTS jobs already queued there and its latency grows with the TTS backlog.
+def read_cpulist(text):
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cores.extend(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def split_evenly(cores, parts):
+    size, extra = divmod(len(cores), parts)
+    sets, start = [], 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        sets.append(cores[start:end] or cores)
+        start = end
+    return sets
+
+
+class CpuTopology:
+    def __init__(self, enabled=True, torch_threads=0, interop_threads=1, encoding_cores=1, whisper_threads=2):
+        self.enabled = enabled
+        self.torch_threads = max(int(torch_threads), 0)
+        self.interop_threads = max(int(interop_threads), 0)
+        self.encoding_cores = max(int(encoding_cores), 0)
+        self.whisper_threads = max(int(whisper_threads), 0)
+        self.can_pin = hasattr(os, "sched_setaffinity")
+        self.nodes = []
+        self.inference_cores = []
+        self.audio_cores = []
+        self.worker_sets = []
+        self.process_sets = []
+        self.next_worker = 0
+        self.lock = threading.Lock()
+        self.encoding_pool = None
+        self.applied = False
+
+    def detect_nodes(self):
+        allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        nodes = []
+        for cpulist in sorted(Path("/sys/devices/system/node").glob("node[0-9]*/cpulist"), key=lambda p: int(p.parent.name[4:])):
+            cores = [core for core in read_cpulist(cpulist.read_text()) if core in allowed]
+            if cores:
+                nodes.append(cores)
+        return nodes or [allowed]
+
+    # Splits the cores between encoding and inference workers. Called at startup, before any model work
+    def apply(self, workers=1, processes=0):
+        if self.applied or not self.enabled:
+            return
+        self.applied = True
+        self.nodes = self.detect_nodes()
+        all_cores = [core for node in self.nodes for core in node]
+        # Encoding cores come off the end of the last node, but never leave inference with fewer than two cores
+        reserve = self.encoding_cores if len(all_cores) - self.encoding_cores >= 2 else 0
+        self.audio_cores = self.nodes[-1][len(self.nodes[-1]) - reserve:] if reserve else []
+        nodes = [[core for core in node if core not in self.audio_cores] for node in self.nodes]
+        nodes = [node for node in nodes if node]
+        self.inference_cores = [core for node in nodes for core in node]
+        self.worker_sets = split_evenly(self.inference_cores, max(workers, 1))
+        self.process_sets = []
+        for index, node in enumerate(nodes):
+            # Processes go round robin over the nodes, then each node's share splits that node's cores
+            share = len(range(index, processes, len(nodes)))
+            if share:
+                self.process_sets.extend(split_evenly(node, share))
+        if processes and not self.process_sets:
+            self.process_sets = split_evenly(self.inference_cores, processes)
+        try:
+            if self.interop_threads:
+                torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # Only allowed before the first inter-op parallel work, which a reload may have already done
+            pass
+        torch.set_num_threads(self.torch_threads or len(self.worker_sets[0]))
+        self.encoding_pool = ThreadPoolExecutor(
+            max_workers=max(len(self.audio_cores), 1),
+            thread_name_prefix="alltalk-encoding",
+            initializer=self.pin,
+            initargs=(self.audio_cores,),
+        )
+        print(
+            f"[{params['branding']}Startup] \033[94mCPU topology\033[0m {len(self.nodes)} NUMA node(s), "
+            f"{len(self.inference_cores)} inference cores, {len(self.audio_cores)} audio encoding cores"
+        )
+
+    # Pins the calling thread. Threads it starts and processes it launches (ffmpeg) inherit the same cores
+    def pin(self, cores, pid=0):
+        if self.can_pin and cores:
+            os.sched_setaffinity(pid, cores)
+
+    # Thread pool initializer for the inference workers, giving each worker thread the next core set
+    def pin_inference_thread(self):
+        if not self.applied:
+            return
+        with self.lock:
+            cores = self.worker_sets[self.next_worker % len(self.worker_sets)]
+            self.next_worker += 1
+        self.pin(cores)
+
+    def threads_for_process(self, index):
+        if not self.applied or not self.process_sets:
+            return 0
+        return self.torch_threads or len(self.process_sets[index % len(self.process_sets)])
+
+    # Transcription shares the inference worker, so with one worker thread the thread count can be swapped around it
+    # without affecting a generation (it queues behind them instead, see above). With more workers it runs uncapped.
+    def run_whisper(self, func, *args, **kwargs):
+        if not self.applied or not self.whisper_threads or inference_executor.workers != 1:
+            return func(*args, **kwargs)
+        previous = torch.get_num_threads()
+        torch.set_num_threads(min(self.whisper_threads, previous))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            torch.set_num_threads(previous)
+
+    # Runs audio writing and encoding on the encoding cores, or on the default thread pool without a topology
+    async def encode(self, func, *args):
+        if self.encoding_pool is None:
+            return await asyncio.to_thread(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(self.encoding_pool, functools.partial(func, *args))
+
+    def stop(self):
+        if self.encoding_pool is not None:
+            self.encoding_pool.shutdown(wait=False)
+            self.encoding_pool = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pinning": self.enabled and self.can_pin,
+            "numa_nodes": self.nodes,
+            "inference_cores": self.inference_cores,
+            "audio_encoding_cores": self.audio_cores,
+            "worker_core_sets": self.worker_sets,
+            "process_core_sets": self.process_sets,
+            "torch_threads": torch.get_num_threads(),
+            "torch_interop_threads": torch.get_num_interop_threads(),
+            "whisper_threads": self.whisper_threads,
+        }
+
+
+cpu_topology = CpuTopology(
+    enabled=params.get("cpu_topology", True),
+    torch_threads=params.get("torch_threads", 0),
+    interop_threads=params.get("torch_interop_threads", 1),
+    encoding_cores=params.get("audio_encoding_cores", 1),
+    whisper_threads=params.get("whisper_threads", 2),
+)
+
+
+############################
+#### INFERENCE EXECUTOR ####
+############################
+# Model calls are synchronous and take seconds, so they run on dedicated worker threads rather than on the event loop.
+# Handlers put jobs on a bounded queue and await the result, which keeps /api/ready, /audio and new connections
+# responsive while synthesis runs. A full queue makes new callers wait for a free slot instead of piling up work.
+# XTTS keeps per call state on the model (the GPT prefix embedding), so keep inference_workers at 1 for XTTS.
+#
+# With inference_processes set, synthesis instead runs in a pool of worker processes forked once the model is loaded.
+# The weights are moved to shared memory first so every worker maps the same pages rather than holding a copy, and
+# each worker gets inference_threads_per_process intra-op threads (0 splits the cores evenly). Forking only works for
+# a model on the CPU. Jobs sent to the pool must be module level functions as they are pickled, and conditioning,
+# transcription and the voice store stay on the threads in this process, where their caches live. With cpu_topology
+# on, each worker thread and worker process is pinned to its own core set and sized to it.
+_STREAM_END = object()
+# How many items a worker's stream may run ahead of the response. Bounds memory for slow clients, and lets
+# streaming encoders hand out views of a small ring of reused buffers.
+STREAM_PENDING_CHUNKS = 4
+# Concurrent streams the worker processes can serve, each holds one slot in the shared stream arrays
+STREAM_SLOTS = 4096
+_process_stream_owners = None
+_process_stream_consumed = None
+_process_stream_queue = None
+
+
+def _init_inference_process(threads, stream_owners, stream_consumed, stream_queue, core_sets, started):
+    global _process_stream_owners, _process_stream_consumed, _process_stream_queue
+    with started.get_lock():
+        index = started.value
+        started.value += 1
+    if core_sets:
+        cpu_topology.pin(core_sets[index % len(core_sets)])
+        threads = threads or len(core_sets[index % len(core_sets)])
+    if threads > 0:
+        torch.set_num_threads(threads)
+    _process_stream_owners = stream_owners
+    _process_stream_consumed = stream_consumed
+    _process_stream_queue = stream_queue
+
+
+def _inference_process_ready(_):
+    return os.getpid()
+
+
+# Runs a generator function inside a worker process, sending its items back over the shared stream queue. The stream
+# owns its slot for as long as the slot holds its id; the parent gives the slot up to stop it early. The parent counts
+# the items it has consumed in the slot, and the worker waits while STREAM_PENDING_CHUNKS items are still unconsumed.
+def _process_stream_job(stream_id, slot, func, args, kwargs):
+    try:
+        iterator = func(*args, **kwargs)
+        produced = 0
+        try:
+            for item in iterator:
+                while _process_stream_owners[slot] == stream_id and produced - _process_stream_consumed[slot] >= STREAM_PENDING_CHUNKS:
+                    time.sleep(0.005)
+                if _process_stream_owners[slot] != stream_id:
+                    break
+                # Views of an encoder's reused buffers cannot be pickled and would not outlive the next chunk anyway
+                _process_stream_queue.put((stream_id, "item", item.tobytes() if isinstance(item, memoryview) else item))
+                produced += 1
+        finally:
+            iterator.close()
+    except Exception as e:
+        _process_stream_queue.put((stream_id, "end", e))
+    else:
+        _process_stream_queue.put((stream_id, "end", None))
+
+
+class InferenceExecutor:
+    def __init__(self, workers=1, queue_size=64, processes=0, threads_per_process=0):
+        self.workers = max(int(workers), 1)
+        self.queue_size = max(int(queue_size), 1)
+        self.processes = max(int(processes), 0)
+        self.threads_per_process = max(int(threads_per_process), 0)
+        self.pool = None
+        self.process_pool = None
+        self.process_ids = []
+        # Slot arrays shared with the worker processes: the id of the stream using each slot (-1 when free), and how
+        # many of its items the parent has consumed. Each is only written by the parent.
+        self.stream_owners = None
+        self.stream_consumed = None
+        self.free_slots = []
+        self.stream_queue = None
+        self.streams = {}
+        self.next_stream_id = 0
+        self.queue = None
+        self.dispatchers = []
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.streams_stopped = 0
+
+    # Needs the running event loop, so this happens at server startup rather than at import
+    def start(self):
+        if self.queue is not None:
+            return
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="alltalk-inference", initializer=cpu_topology.pin_inference_thread
+        )
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        # One dispatcher per thread and per process, so jobs for the thread pool never hold up the processes
+        self.dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers + self.processes)]
+
+    # Called once the model is loaded (and again after a model change, as workers hold the model they forked with)
+    def start_processes(self):
+        self.stop_processes()
+        if self.processes == 0:
+            return
+        if not (params["tts_method_xtts_local"] or tts_method_xtts_ft) or str(model.device) != "cpu" or params["low_vram"]:
+            print(f"[{params['branding']}Model] \033[91mWarning\033[0m inference_processes needs an XTTS model on the CPU, using worker threads")
+            return
+        context = multiprocessing.get_context("fork")
+        core_sets = cpu_topology.process_sets
+        threads = self.threads_per_process or cpu_topology.threads_for_process(0) or max((os.cpu_count() or 1) // self.processes, 1)
+        model.share_memory()
+        self.stream_owners = context.RawArray("q", [-1] * STREAM_SLOTS)
+        self.stream_consumed = context.RawArray("q", STREAM_SLOTS)
+        self.free_slots = list(range(STREAM_SLOTS))
+        self.stream_queue = context.Queue()
+        self.process_pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=context,
+            initializer=_init_inference_process,
+            # A pinned worker sizes its threads to its own core set unless a count is configured
+            initargs=(
+                (self.threads_per_process or cpu_topology.torch_threads) if core_sets else threads,
+                self.stream_owners,
+                self.stream_consumed,
+                self.stream_queue,
+                core_sets,
+                context.Value("i", 0),
+            ),
+        )
+        # Fork every worker up front, while this process is still quiet, rather than on the first request
+        self.process_ids = list(self.process_pool.map(_inference_process_ready, range(self.processes)))
+        threading.Thread(target=self._route_stream_items, args=(self.stream_queue,), daemon=True).start()
+        print(f"[{params['branding']}Model] \033[94mInference workers\033[0m {self.processes} processes x {threads} threads")
+
+    def stop_processes(self):
+        if self.process_pool is None:
+            return
+        self.process_pool.shutdown(wait=False, cancel_futures=True)
+        self.stream_queue.put(None)
+        self.process_pool = None
+        self.process_ids = []
+
+    async def stop(self):
+        self.stop_processes()
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.dispatchers = []
+        while self.queue is not None and not self.queue.empty():
+            _, _, _, future, _ = self.queue.get_nowait()
+            future.cancel()
+        self.queue = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def _route_stream_items(self, stream_queue):
+        while True:
+            message = stream_queue.get()
+            if message is None:
+                return
+            stream_id, kind, payload = message
+            target = self.streams.get(stream_id)
+            if target is not None:
+                loop, items = target
+                loop.call_soon_threadsafe(items.put_nowait, (kind, payload))
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, kwargs, future, in_process = await self.queue.get()
+            # The caller stopped waiting while the job sat in the queue
+            if future.done():
+                self.dropped += 1
+                continue
+            pool = self.process_pool if in_process and self.process_pool is not None else self.pool
+            self.active += 1
+            try:
+                result = await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.active -= 1
+
+    async def _submit(self, func, args, kwargs, in_process):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, kwargs, future, in_process))
+        return await future
+
+    async def run(self, func, *args, **kwargs):
+        return await self._submit(func, args, kwargs, False)
+
+    # Synthesis jobs, which go to the worker processes when there are any
+    async def synthesize(self, func, *args, **kwargs):
+        return await self._submit(func, args, kwargs, True)
+
+    # Runs a generator function on a worker and yields its items on the event loop as they are produced. Leaving the
+    # loop early stops the generator at its next item and frees the worker. On a thread or process worker the
+    # generator waits while STREAM_PENDING_CHUNKS items are still unconsumed, and an item counts as consumed once the
+    # caller asks for the next one.
+    async def stream(self, func, *args, **kwargs):
+        if self.process_pool is not None:
+            async for item in self._stream_from_process(func, args, kwargs):
+                yield item
+            return
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+        pending = threading.Semaphore(STREAM_PENDING_CHUNKS)
+
+        def pump():
+            iterator = func(*args, **kwargs)
+            try:
+                for item in iterator:
+                    while not pending.acquire(timeout=0.1) and not stop.is_set():
+                        pass
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, (item, None))
+            finally:
+                iterator.close()
+
+        def finished(job):
+            error = None if job.cancelled() else job.exception()
+            items.put_nowait((_STREAM_END, error))
+
+        job = asyncio.ensure_future(self.run(pump))
+        job.add_done_callback(finished)
+        ended = False
+        try:
+            while True:
+                item, error = await items.get()
+                if item is _STREAM_END:
+                    ended = True
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+                pending.release()
+        finally:
+            stop.set()
+            if not ended:
+                self.streams_stopped += 1
+            if not job.done():
+                job.cancel()
+
+    async def _stream_from_process(self, func, args, kwargs):
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        if not self.free_slots:
+            raise RuntimeError(f"More than {STREAM_SLOTS} concurrent streams on the inference processes")
+        # A worker still finishing the slot's previous stream sees the new owner and stops
+        slot = self.free_slots.pop()
+        self.stream_consumed[slot] = 0
+        self.stream_owners[slot] = stream_id
+        items = asyncio.Queue()
+        self.streams[stream_id] = (asyncio.get_running_loop(), items)
+
+        # The worker reports the end of the stream itself, this only catches a job that never ran or a dead worker
+        def finished(job):
+            if job.cancelled() or job.exception() is not None:
+                items.put_nowait(("end", None if job.cancelled() else job.exception()))
+
+        job = asyncio.ensure_future(self.synthesize(_process_stream_job, stream_id, slot, func, args, kwargs))
+        job.add_done_callback(finished)
+        ended = False
+        try:
+            while True:
+                kind, payload = await items.get()
+                if kind == "end":
+                    ended = True
+                    if payload is not None:
+                        raise payload
+                    return
+                yield payload
+                self.stream_consumed[slot] += 1
+        finally:
+            self.stream_owners[slot] = -1
+            self.free_slots.append(slot)
+            if not ended:
+                self.streams_stopped += 1
+            self.streams.pop(stream_id, None)
+            if not job.done():
+                job.cancel()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "processes": len(self.process_ids),
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "streams_stopped": self.streams_stopped,
+        }
+
+
+inference_executor = InferenceExecutor(
+    params.get("inference_workers", 1),
+    params.get("inference_queue_size", 64),
+    params.get("inference_processes", 0),
+    params.get("inference_threads_per_process", 0),
+)
+
+
+# Plain model.inference, as a module level function so it can be sent to a worker process. Seeding happens on the
+# worker, right before the inference that should be reproducible.
+@torch.inference_mode()
+def xtts_inference_job(seed=None, **inference_args):
+    if seed is not None:
+        torch.manual_seed(seed)
+    return {"wav": model.inference(**inference_args)["wav"]}
+
+
+# How many GPT tokens a stream generates before each decode. A fixed size trades first audio latency against decoder
+# overhead the same way for every request, and XTTS decodes the whole sentence so far on every chunk, so small chunks
+# cost more the longer a sentence runs. The adaptive policy sizes the first chunk to reach first audio within
+# stream_ttfa_ms at this worker's measured speed, then makes each chunk as large as the audio already sent allows,
+# so playback stays ahead of synthesis. The speed estimate is kept per worker process across requests.
+_stream_speed = {"token_seconds": None, "decode_seconds": None}
+
+
+class StreamChunker:
+    """
+    Picks the size of each chunk of a stream and keeps a playback clock for it. The clock starts with the first
+    chunk; a chunk that arrives after the audio before it has run out counts as an underrun and restarts the clock.
+    """
+    def __init__(self, policy="adaptive", chunk_size=20, ttfa_ms=500, min_chunk=8, max_chunk=80):
+        self.policy = policy
+        self.chunk_size = max(int(chunk_size), 1)
+        self.ttfa = max(float(ttfa_ms), 0) / 1000
+        self.min_chunk = max(int(min_chunk), 1)
+        self.max_chunk = max(int(max_chunk), self.min_chunk)
+        self.started = time.perf_counter()
+        self.first_audio = None
+        self.playback_start = None
+        self.audio_seconds = 0.0
+        self.sizes = []
+        self.underruns = 0
+        self.underrun_seconds = 0.0
+
+    def buffered(self):
+        return self.audio_seconds - (time.perf_counter() - self.playback_start)
+
+    # latents is how many GPT latents of the current sentence the next decode will already include
+    def next_size(self, latents):
+        if self.policy != "adaptive":
+            return self.chunk_size
+        token_seconds, decode_seconds = _stream_speed["token_seconds"], _stream_speed["decode_seconds"]
+        if token_seconds is None:
+            return self.min_chunk
+        if self.first_audio is None:
+            budget = self.ttfa - (time.perf_counter() - self.started)
+        else:
+            # Keep a fifth of the buffer spare for jitter
+            budget = self.buffered() * 0.8
+        size = (budget - latents * decode_seconds) / (token_seconds + decode_seconds)
+        return int(min(max(size, self.min_chunk), self.max_chunk))
+
+    def record(self, tokens, latents, token_seconds, decode_seconds, samples):
+        alpha = 0.3
+        for key, value in (("token_seconds", token_seconds / max(tokens, 1)), ("decode_seconds", decode_seconds / max(latents, 1))):
+            previous = _stream_speed[key]
+            _stream_speed[key] = value if previous is None else previous + alpha * (value - previous)
+        now = time.perf_counter()
+        if self.first_audio is None:
+            self.first_audio = self.playback_start = now
+        elif self.buffered() < 0:
+            self.underruns += 1
+            self.underrun_seconds -= self.buffered()
+            self.playback_start = now
+            self.audio_seconds = 0.0
+        self.audio_seconds += samples / 24000
+        self.sizes.append(tokens)
+
+    def report(self):
+        return {
+            "policy": self.policy,
+            "worker_ttfa_ms": (self.first_audio - self.started) * 1000 if self.first_audio else None,
+            "chunk_sizes": self.sizes,
+            "underruns": self.underruns,
+            "underrun_ms": self.underrun_seconds * 1000,
+        }
+
+
+# Model.inference_stream with the chunk size chosen per chunk. Same sentence splitting, generation, decoding and
+# overlap handling as the XTTS implementation, which only takes one stream_chunk_size for the whole request.
+def xtts_stream_chunks(chunker, text, language, gpt_cond_latent, speaker_embedding, temperature=0.75, length_penalty=1.0,
+                       repetition_penalty=10.0, top_k=50, top_p=0.85, do_sample=True, speed=1.0, enable_text_splitting=False,
+                       overlap_wav_len=1024):
+    language = language.split("-")[0]
+    length_scale = 1.0 / max(speed, 0.05)
+    gpt_cond_latent = gpt_cond_latent.to(model.device)
+    speaker_embedding = speaker_embedding.to(model.device)
+    sentences = split_sentence(text, language, model.tokenizer.char_limits[language]) if enable_text_splitting else [text]
+    for sentence in sentences:
+        sentence = sentence.strip().lower()
+        text_tokens = torch.IntTensor(model.tokenizer.encode(sentence, lang=language)).unsqueeze(0).to(model.device)
+        assert (
+            text_tokens.shape[-1] < model.args.gpt_max_text_tokens
+        ), " ❗ XTTS can only generate text with a maximum of 400 tokens."
+        fake_inputs = model.gpt.compute_embeddings(gpt_cond_latent, text_tokens)
+        gpt_generator = model.gpt.get_generator(
+            fake_inputs=fake_inputs,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            do_sample=do_sample,
+            num_beams=1,
+            num_return_sequences=1,
+            length_penalty=float(length_penalty),
+            repetition_penalty=float(repetition_penalty),
+            output_attentions=False,
+            output_hidden_states=True,
+        )
+        all_latents = []
+        wav_gen_prev = None
+        wav_overlap = None
+        is_end = False
+        while not is_end:
+            size = chunker.next_size(len(all_latents))
+            tokens = 0
+            start = time.perf_counter()
+            while tokens < size:
+                try:
+                    _, latent = next(gpt_generator)
+                except StopIteration:
+                    is_end = True
+                    break
+                all_latents.append(latent)
+                tokens += 1
+            if not all_latents:
+                break
+            generated = time.perf_counter()
+            gpt_latents = torch.cat(all_latents, dim=0)[None, :]
+            if length_scale != 1.0:
+                gpt_latents = torch.nn.functional.interpolate(
+                    gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear"
+                ).transpose(1, 2)
+            wav_gen = model.hifigan_decoder(gpt_latents, g=speaker_embedding)
+            wav_chunk, wav_gen_prev, wav_overlap = model.handle_chunks(wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len)
+            chunker.record(tokens, len(all_latents), generated - start, time.perf_counter() - generated, wav_chunk.shape[0])
+            yield wav_chunk
+
+
+class PCM16Encoder:
+    """
+    Converts float audio chunks to PCM16 without allocating per chunk. Clamping and scaling happen in a float scratch
+    buffer on the chunk's own device, and the int16 result lands in the next of a ring of preallocated host buffers
+    (pinned for CUDA, so the copy back is one transfer of half the size). Buffers only grow, to the largest chunk
+    seen, so memory stays fixed however long the stream runs. encode() returns a memoryview that stays valid until
+    the ring comes round again. InferenceExecutor.stream never lets the worker get more than STREAM_PENDING_CHUNKS
+    items ahead of the response, and the spare slots cover the last chunks still sitting in the socket's write buffer.
+    """
+    def __init__(self, slots=STREAM_PENDING_CHUNKS + 4):
+        self.slots = [None] * slots
+        self.next_slot = 0
+        self.scratch = None
+
+    @staticmethod
+    def capacity(samples):
+        return 1 << max(samples - 1, 1).bit_length()
+
+    def encode(self, chunk):
+        samples = chunk.shape[0]
+        if self.scratch is None or self.scratch.device != chunk.device or self.scratch.shape[0] < samples:
+            self.scratch = torch.empty(self.capacity(samples), dtype=torch.float32, device=chunk.device)
+        work = self.scratch[:samples]
+        torch.clamp(chunk, -1, 1, out=work)
+        work.mul_(32767)
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % len(self.slots)
+        buffer = self.slots[slot]
+        if buffer is None or buffer.shape[0] < samples:
+            buffer = torch.empty(self.capacity(samples), dtype=torch.int16, pin_memory=chunk.is_cuda)
+            self.slots[slot] = buffer
+        # Casting truncates toward zero, the same as numpy's astype(np.int16)
+        buffer[:samples].copy_(work)
+        return memoryview(buffer.numpy()[:samples]).cast("B")
+
+
+# XTTS streaming on an inference worker, yielding the PCM16 audio that follows the WAV header and, last, the chunker's
+# report for the request
+@torch.inference_mode()
+def xtts_stream_pcm(chunking=None, **inference_args):
+    chunker = StreamChunker(**(chunking or {}))
+    encoder = PCM16Encoder()
+    for chunk in xtts_stream_chunks(chunker, **inference_args):
+        yield encoder.encode(chunk)
+    yield chunker.report()
+
+
+class StreamMetrics:
+    """
+    Time to first audio and underruns of recent streams. TTFA is measured here, from the start of generation to the
+    first audio handed to the response, so it includes the wait for a worker.
+    """
+    def __init__(self, keep=200):
+        self.recent = deque(maxlen=keep)
+        self.streams = 0
+        self.underruns = 0
+        self.streams_with_underruns = 0
+
+    def record(self, ttfa_seconds, report):
+        self.streams += 1
+        entry = {"ttfa_ms": ttfa_seconds * 1000 if ttfa_seconds is not None else None, "completed": report is not None}
+        if report is not None:
+            entry.update(report)
+            self.underruns += report["underruns"]
+            self.streams_with_underruns += 1 if report["underruns"] else 0
+        self.recent.append(entry)
+        return entry
+
+    def stats(self):
+        ttfas = sorted(entry["ttfa_ms"] for entry in self.recent if entry["ttfa_ms"] is not None)
+        return {
+            "streams": self.streams,
+            "underruns": self.underruns,
+            "streams_with_underruns": self.streams_with_underruns,
+            "ttfa_ms": {
+                "samples": len(ttfas),
+                "p50": ttfas[len(ttfas) // 2] if ttfas else 0,
+                "p95": ttfas[int(len(ttfas) * 0.95)] if ttfas else 0,
+            },
+            "recent": list(self.recent)[-20:],
+        }
+
+
+stream_metrics = StreamMetrics()
+
+
+# Chunking for one stream, the configured defaults overridden by what the request asked for
+def stream_chunking(stream_settings=None):
+    stream_settings = stream_settings or {}
+    policy = stream_settings.get("policy") or params.get("stream_chunk_policy", "adaptive")
+    return {
+        "policy": policy if policy in ("fixed", "adaptive") else "adaptive",
+        "chunk_size": params.get("stream_chunk_size", 20),
+        "ttfa_ms": stream_settings.get("ttfa_ms") or params.get("stream_ttfa_ms", 500),
+        "min_chunk": params.get("stream_chunk_min", 8),
+        "max_chunk": params.get("stream_chunk_max", 80),
+    }
+
+
+# Name of a file in the outputs folder from a client supplied name. Only a bare file name is accepted, so a request
+# can never point a write outside the outputs folder.
+def output_path(output_file):
+    name = str(output_file or "")
+    if not name or "/" in name or "\\" in name or ".." in name or Path(name).name != name:
+        raise HTTPException(status_code=400, detail="output_file must be a plain file name")
+    return this_dir / "outputs" / name
+
+
+def in_outputs_folder(path):
+    return Path(path).resolve().parent == (this_dir / "outputs").resolve()
+
+
+# Streaming response body shared by the generation functions, a WAV header followed by the audio as it is generated.
+# With an output_file (which must be in the outputs folder) the audio is also written there as it streams. The file is
+# built next to its destination and only moved into place, with its WAV header completed, once the stream finishes;
+# a cancelled or failed stream deletes it. Streams are unseeded, so they are only cached when the caller asked for it
+# (use_cache True): the finished file goes into the result cache, and a stream whose audio is already cached is
+# replayed from there instead of generated again.
+async def stream_xtts_audio(inference_args, stream_settings=None, output_file=None, voice_key=None, preserve_duration=False, use_cache=None):
+    if output_file is not None and not in_outputs_folder(output_file):
+        raise ValueError(f"Refusing to write a stream outside the outputs folder: {output_file}")
+    key = None
+    if output_file is not None and voice_key is not None and use_cache is True:
+        key = await xtts_stream_key(inference_args, output_file, voice_key, preserve_duration)
+    if key is not None:
+        cached = await asyncio.to_thread(read_cached, key)
+        if cached is not None:
+            print(f"[{params['branding']}TTSGen] \033[94mStream replayed from the result cache\033[0m")
+            await asyncio.to_thread(Path(output_file).write_bytes, cached)
+            view = memoryview(cached)
+            for start in range(0, len(view), 65536):
+                yield view[start:start + 65536]
+            return
+    wav_buf = io.BytesIO()
+    with wave.open(wav_buf, "wb") as vfout:
+        vfout.setnchannels(1)
+        vfout.setsampwidth(2)
+        vfout.setframerate(24000)
+        vfout.writeframes(b"")
+    wav_buf.seek(0)
+    yield wav_buf.read()
+    tee = None
+    if output_file is not None:
+        temp_path = Path(output_file).with_name(f"{Path(output_file).name}.{uuid.uuid4().hex}.part")
+        tee = wave.open(str(temp_path), "wb")
+        tee.setnchannels(1)
+        tee.setsampwidth(2)
+        tee.setframerate(24000)
+    start = time.perf_counter()
+    ttfa = None
+    report = None
+    completed = False
+    try:
+        async for item in inference_executor.stream(xtts_stream_pcm, chunking=stream_chunking(stream_settings), **inference_args):
+            if isinstance(item, dict):
+                report = item
+                continue
+            if ttfa is None:
+                ttfa = time.perf_counter() - start
+            # Written here rather than on another thread, as the chunk is a view of a buffer the worker will reuse.
+            # One chunk is tens of KB, which goes to the page cache without blocking.
+            if tee is not None:
+                tee.writeframesraw(item)
+            yield item
+        completed = True
+    finally:
+        entry = stream_metrics.record(ttfa, report)
+        if report is not None:
+            print(
+                f"[{params['branding']}TTSGen] \033[94mStream TTFA\033[0m {entry['ttfa_ms'] or 0:.0f} ms, "
+                f"{report['underruns']} underruns, chunks {report['chunk_sizes']}"
+            )
+        if tee is not None:
+            # Closing patches the frame count into the header
+            tee.close()
+            if completed:
+                os.replace(temp_path, output_file)
+            else:
+                temp_path.unlink(missing_ok=True)
+    if completed and key is not None:
+        await asyncio.to_thread(result_cache.put, key, output_file)
+
+
+@app.get("/api/streaming")
+async def streaming_stats():
+    return JSONResponse(content=stream_metrics.stats())
+
+
+#########################
+#### STREAM ENCODING ####
+#########################
+# Raw PCM16 at 24 kHz is about 384 kbit/s per listener. Streaming endpoints can instead ask for ?format=opus (Ogg/Opus,
+# stream_opus_kbps) or ?format=mp3 (MP3 frames, stream_mp3_kbps), encoded as the audio is generated by an ffmpeg
+# process per stream, the same ffmpeg pydub uses. ffmpeg is told not to buffer its input and to write every packet as
+# soon as it is encoded, and Ogg pages are cut every 20 ms, so the codec adds tens of milliseconds rather than waiting
+# on its own buffers. With a cpu_topology the encoder runs on the audio encoding cores. File generations are not
+# affected and keep their formats.
+STREAM_CODECS = {
+    "wav": {"media_type": "audio/wav"},
+    "opus": {
+        "media_type": "audio/ogg",
+        "args": lambda: ["-c:a", "libopus", "-b:a", f"{params.get('stream_opus_kbps', 32)}k", "-application", "audio",
+                         "-frame_duration", "20", "-page_duration", "20000", "-f", "ogg"],
+    },
+    "mp3": {
+        "media_type": "audio/mpeg",
+        "args": lambda: ["-c:a", "libmp3lame", "-b:a", f"{params.get('stream_mp3_kbps', 64)}k", "-f", "mp3"],
+    },
+}
+STREAM_CODECS["ogg"] = STREAM_CODECS["opus"]
+
+
+# The codec for a streaming request, the configured stream_format when it did not ask for one
+def stream_codec(audio_format=None):
+    audio_format = (audio_format or params.get("stream_format", "wav")).lower()
+    if audio_format not in STREAM_CODECS:
+        raise HTTPException(status_code=400, detail=f"Unsupported stream format {audio_format}, use one of {', '.join(STREAM_CODECS)}")
+    if audio_format != "wav" and shutil.which(AudioSegment.converter) is None:
+        raise HTTPException(status_code=400, detail=f"Stream format {audio_format} needs ffmpeg, which was not found")
+    return audio_format
+
+
+# PCM samples of a WAV stream, skipping everything up to and including the data chunk header
+async def wav_stream_samples(stream):
+    header = b""
+    async for chunk in stream:
+        if header is None:
+            yield chunk
+            continue
+        header += bytes(chunk)
+        position = header.find(b"data")
+        if position < 0 or len(header) < position + 8:
+            continue
+        samples, header = header[position + 8:], None
+        if samples:
+            yield samples
+
+
+# Encodes a WAV stream (as stream_xtts_audio yields it) with ffmpeg, yielding the encoded bytes as ffmpeg writes them.
+# Leaving early closes the source stream, which stops generation, and kills the encoder.
+async def encode_stream(stream, audio_format):
+    process = await asyncio.create_subprocess_exec(
+        AudioSegment.converter, "-hide_banner", "-loglevel", "error",
+        "-fflags", "+nobuffer", "-probesize", "32", "-analyzeduration", "0",
+        "-f", "s16le", "-ar", "24000", "-ac", "1", "-i", "pipe:0",
+        *STREAM_CODECS[audio_format]["args"](), "-flush_packets", "1", "pipe:1",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    if cpu_topology.applied:
+        cpu_topology.pin(cpu_topology.audio_cores, process.pid)
+
+    async def feed():
+        try:
+            async for samples in wav_stream_samples(stream):
+                # The pipe transport copies the data, so a view of a reused buffer is safe to pass on
+                process.stdin.write(samples)
+                await process.stdin.drain()
+        finally:
+            await stream.aclose()
+            process.stdin.close()
+
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while True:
+            data = await process.stdout.read(65536)
+            if not data:
+                break
+            yield data
+        await feeder
+    finally:
+        feeder.cancel()
+        with contextlib.suppress(BaseException):
+            await feeder
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+
+def streaming_audio_response(stream, audio_format):
+    if audio_format != "wav":
+        stream = encode_stream(stream, audio_format)
+    return StreamingResponse(stream, media_type=STREAM_CODECS[audio_format]["media_type"])
+
+
+# Save a finished XTTS waveform and apply the pitch shift. preserve_duration time stretches the shifted audio back
+# to its original length. Runs off the event loop as pydub and rubberband call out to ffmpeg.
+def write_generated_audio(wav, output_file, pitch, preserve_duration=False):
+    output_file = str(output_file)
+    wav_output_file = output_file.replace('mp3', 'wav')
+    torchaudio.save(wav_output_file, torch.tensor(wav).unsqueeze(0), 24000)
+    if pitch == 0:
+        AudioSegment.from_wav(wav_output_file).export(output_file, format="mp3")
+        return
+    audio = AudioSegment.from_wav(wav_output_file)
+    octaves = pitch / 12
+    new_sample_rate = int(audio.frame_rate * (2 ** octaves))
+    hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
+    hipitched_sound = hipitched_sound.set_frame_rate(24000)  # 设置最终采样率为24000Hz
+    if not preserve_duration:
+        # 直接导出为MP3，不需要转回WAV然后再到MP3
+        hipitched_sound.export(output_file, format="mp3")
+        return
+    # 使用pyrubberband处理时间拉伸
+    speed = 1 / (2 ** (pitch / 12))
+    y, sr = librosa.load(hipitched_sound.export(format="wav"), sr=None)
+    y_stretched = pyrubberband.time_stretch(y, sr, speed)
+    sf.write(output_file, y_stretched, sr, format='wav')
+    final_audio = AudioSegment.from_wav(output_file)
+    final_audio.export(output_file, format="mp3")
+
+
+########################
+#### MICRO-BATCHING ####
+########################
+# Sentences from concurrent XTTS requests that arrive within micro_batch_window_ms of each other go through the GPT
+# decoder as one padded batch. Only requests with the same sampling settings can share a batch, as generate() takes
+# them per call. The window restarts on every arrival but a batch never waits longer than micro_batch_max_wait_ms,
+# and when only one request is using the batcher there is nothing to wait for, so its sentences go straight out.
+# This is a separate GPT path from model.inference and is off by default (micro_batch_size 1). The rows of a batch
+# draw from one sampling RNG stream, so a sentence's audio is an equally valid sample but depends on what else was
+# in its batch; seeded generations never use it.
+@torch.inference_mode()
+def xtts_synthesize_batch(jobs, sampling):
+    gpt = model.gpt
+    text_tokens = []
+    prefixes = []
+    for job in jobs:
+        tokens = torch.IntTensor(model.tokenizer.encode(job["text"].strip().lower(), lang=job["language"])).unsqueeze(0).to(model.device)
+        if tokens.shape[-1] >= model.args.gpt_max_text_tokens:
+            raise ValueError("XTTS can only generate text with a maximum of 400 tokens.")
+        text_tokens.append(tokens)
+        # Same prefix GPT.compute_embeddings builds: conditioning latents then the text between start/stop tokens
+        text_inputs = torch.nn.functional.pad(tokens, (0, 1), value=gpt.stop_text_token)
+        text_inputs = torch.nn.functional.pad(text_inputs, (1, 0), value=gpt.start_text_token)
+        text_emb = gpt.text_embedding(text_inputs) + gpt.text_pos_embedding(text_inputs)
+        prefixes.append(torch.cat([job["gpt_cond_latent"].to(model.device), text_emb], dim=1)[0])
+
+    # Left pad the prefixes and mask the padding out, so every row starts generating audio tokens in the same column
+    longest = max(prefix.shape[0] for prefix in prefixes)
+    prefix_emb = prefixes[0].new_zeros((len(prefixes), longest, prefixes[0].shape[-1]))
+    attention_mask = torch.zeros((len(prefixes), longest + 1), dtype=torch.long, device=model.device)
+    for row, prefix in enumerate(prefixes):
+        prefix_emb[row, longest - prefix.shape[0] :] = prefix
+        attention_mask[row, longest - prefix.shape[0] :] = 1
+    gpt.gpt_inference.store_prefix_emb(prefix_emb)
+    gpt_inputs = torch.full((len(prefixes), longest + 1), fill_value=1, dtype=torch.long, device=model.device)
+    gpt_inputs[:, -1] = gpt.start_audio_token
+    codes = gpt.gpt_inference.generate(
+        gpt_inputs,
+        attention_mask=attention_mask,
+        bos_token_id=gpt.start_audio_token,
+        pad_token_id=gpt.stop_audio_token,
+        eos_token_id=gpt.stop_audio_token,
+        max_length=gpt.max_gen_mel_tokens + gpt_inputs.shape[-1],
+        do_sample=True,
+        num_return_sequences=1,
+        num_beams=1,
+        output_attentions=False,
+        **sampling,
+    )[:, gpt_inputs.shape[-1] :]
+
+    wavs = []
+    for job, tokens, row_codes in zip(jobs, text_tokens, codes):
+        # Finished rows are padded with stop tokens, keep each row up to and including its first one
+        stops = (row_codes == gpt.stop_audio_token).nonzero()
+        gpt_codes = row_codes[: stops[0].item() + 1 if len(stops) else row_codes.shape[0]].unsqueeze(0)
+        gpt_latents = gpt(
+            tokens,
+            torch.tensor([tokens.shape[-1]], device=model.device),
+            gpt_codes,
+            torch.tensor([gpt_codes.shape[-1] * gpt.code_stride_len], device=model.device),
+            cond_latents=job["gpt_cond_latent"].to(model.device),
+            return_attentions=False,
+            return_latent=True,
+        )
+        length_scale = 1.0 / max(job["speed"], 0.05)
+        if length_scale != 1.0:
+            gpt_latents = torch.nn.functional.interpolate(
+                gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear"
+            ).transpose(1, 2)
+        wavs.append(model.hifigan_decoder(gpt_latents, g=job["speaker_embedding"].to(model.device)).cpu().squeeze())
+    return wavs
+
+
+class MicroBatcher:
+    def __init__(self, max_batch_size=4, window_ms=20, max_wait_ms=50):
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.window = window_ms / 1000
+        self.max_wait = max(max_wait_ms, window_ms) / 1000
+        self.pending = {}
+        self.timers = {}
+        self.batch_sizes = {}
+        self.dropped = 0
+        self.queue_times = deque(maxlen=1000)
+        # Requests currently submitting sentences, see submit_all
+        self.callers = 0
+
+    # All the sentences of one request. Only while another request is also submitting is there a reason to wait.
+    async def submit_all(self, sampling, jobs):
+        self.callers += 1
+        try:
+            return await asyncio.gather(*[self.submit(sampling, job) for job in jobs])
+        finally:
+            self.callers -= 1
+
+    async def submit(self, sampling, job):
+        loop = asyncio.get_running_loop()
+        key = tuple(sorted(sampling.items()))
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((job, future, time.perf_counter()))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif self.callers <= 1:
+            # Nothing else can join: flush once the request's own sentences, already scheduled, have been added
+            if key not in self.timers:
+                self.timers[key] = loop.call_soon(self._flush, key)
+        else:
+            # Wait for more arrivals, but never past max_wait from the oldest sentence in the batch
+            if key in self.timers:
+                self.timers[key].cancel()
+            delay = min(self.window, batch[0][2] + self.max_wait - time.perf_counter())
+            self.timers[key] = loop.call_later(max(delay, 0), self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self.pending.pop(key, [])
+        batch = [entry for entry in pending if not entry[1].done()]
+        # Sentences whose request was cancelled while they waited for the batch
+        self.dropped += len(pending) - len(batch)
+        if batch:
+            asyncio.ensure_future(self._run(dict(key), batch))
+
+    async def _run(self, sampling, batch):
+        flushed = time.perf_counter()
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        self.queue_times.extend(flushed - enqueued for _, _, enqueued in batch)
+        try:
+            wavs = await inference_executor.synthesize(xtts_synthesize_batch, [job for job, _, _ in batch], sampling)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), wav in zip(batch, wavs):
+            if not future.done():
+                future.set_result(wav)
+
+    def stats(self):
+        queue_times = sorted(self.queue_times)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "window_ms": self.window * 1000,
+            "max_wait_ms": self.max_wait * 1000,
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "dropped_sentences": self.dropped,
+            "queue_time_ms": {
+                "samples": len(queue_times),
+                "mean": sum(queue_times) / len(queue_times) * 1000 if queue_times else 0,
+                "p50": queue_times[len(queue_times) // 2] * 1000 if queue_times else 0,
+                "p95": queue_times[int(len(queue_times) * 0.95)] * 1000 if queue_times else 0,
+            },
+        }
+
+
+micro_batcher = MicroBatcher(
+    params.get("micro_batch_size", 1), params.get("micro_batch_window_ms", 20), params.get("micro_batch_max_wait_ms", 50)
+)
+
+
+# Seed for one sentence of a seeded generation, from the request seed and the sentence text rather than its position,
+# so a sentence sounds the same (and hits the same fragment) wherever it appears in a text
+def sentence_seed(seed, sentence):
+    if seed is None:
+        return None
+    digest = hashlib.sha256(" ".join(sentence.split()).encode("utf-8")).digest()
+    return (seed + int.from_bytes(digest[:4], "little")) % 2**32
+
+
+# Joins per sentence audio in order. sentence_silence_ms puts a pause between sentences and sentence_crossfade_ms
+# blends each boundary, overlapping the sentences when there is no pause and fading into and out of it when there is.
+def stitch_sentences(wavs, silence_ms=0, crossfade_ms=0, sample_rate=24000):
+    wavs = [np.asarray(wav, dtype=np.float32) for wav in wavs]
+    silence = np.zeros(int(sample_rate * silence_ms / 1000), dtype=np.float32)
+    fade = int(sample_rate * crossfade_ms / 1000)
+    pieces = [wavs[0]]
+    for wav in wavs[1:]:
+        previous = pieces[-1]
+        length = min(fade, len(previous), len(wav))
+        if length == 0:
+            pieces += [silence, wav]
+            continue
+        ramp = np.linspace(0.0, 1.0, length, dtype=np.float32)
+        if silence.size:
+            pieces[-1] = np.concatenate([previous[:-length], previous[-length:] * ramp[::-1]])
+            pieces += [silence, np.concatenate([wav[:length] * ramp, wav[length:]])]
+        else:
+            overlap = previous[-length:] * ramp[::-1] + wav[:length] * ramp
+            pieces[-1] = previous[:-length]
+            pieces += [overlap, wav[length:]]
+    return np.concatenate(pieces)
+
+
+# Non streaming XTTS generation. The text is split into sentences up front, the same way model.inference splits it,
+# and the sentences are generated concurrently, either in micro batches or as separate jobs spread over the
+# inference workers, then stitched back together in order. The result is the {"wav": ...} model.inference returns.
+# Seeded generations skip micro batching, as the rows sampled alongside a sentence would change its output, and
+# each sentence gets its own seed so the result does not depend on the order the workers pick them up in.
+# With fragment_settings (the voice and generation settings) each sentence is first looked up in the fragment cache
+# and only the misses are generated, so texts that share sentences only pay for the sentences that differ. The hits
+# of each request are recorded in fragment_metrics.
+async def xtts_inference(inference_args, seed=None, fragment_settings=None):
+    language = inference_args["language"].split("-")[0]
+    text = inference_args["text"]
+    sentences = split_sentence(text, language, model.tokenizer.char_limits[language]) if inference_args.get("enable_text_splitting") else [text]
+    seeds = [sentence_seed(seed, sentence) for sentence in sentences]
+    wavs = [None] * len(sentences)
+    fragment_keys = []
+    if fragment_settings is not None:
+        fragment_keys = [
+            fragment_cache.make_key(sentence, seed=sentence_seed, **fragment_settings)
+            for sentence, sentence_seed in zip(sentences, seeds)
+        ]
+        wavs = await asyncio.to_thread(load_fragments, fragment_keys)
+        hits = sum(wav is not None for wav in wavs)
+        fragment_metrics.record(len(sentences), hits)
+        print(f"[{params['branding']}TTSGen] Fragment cache \033[93m{hits}/{len(sentences)}\033[0m sentences ({hits / len(sentences):.0%})")
+    missing = [index for index, wav in enumerate(wavs) if wav is None]
+    if missing and micro_batcher.max_batch_size > 1 and seed is None:
+        sampling = {key: inference_args[key] for key in ("temperature", "length_penalty", "repetition_penalty", "top_k", "top_p")}
+        job = {key: inference_args[key] for key in ("gpt_cond_latent", "speaker_embedding", "speed")}
+        generated = await micro_batcher.submit_all(
+            sampling, [dict(job, text=sentences[index], language=language) for index in missing]
+        )
+        for index, wav in zip(missing, generated):
+            wavs[index] = wav.numpy()
+    elif missing and len(sentences) > 1 and (params.get("sentence_parallel", True) or fragment_settings is not None):
+        outputs = await asyncio.gather(*[
+            inference_executor.synthesize(
+                xtts_inference_job,
+                seed=seeds[index],
+                **dict(inference_args, text=sentences[index], enable_text_splitting=False),
+            )
+            for index in missing
+        ])
+        for index, output in zip(missing, outputs):
+            wavs[index] = output["wav"]
+    elif missing:
+        output = await inference_executor.synthesize(xtts_inference_job, seed=seeds[0] if len(sentences) == 1 else seed, **inference_args)
+        if len(sentences) > 1:
+            return output
+        wavs = [output["wav"]]
+    if fragment_settings is not None and missing:
+        await asyncio.to_thread(store_fragments, [fragment_keys[index] for index in missing], [wavs[index] for index in missing])
+    return {"wav": stitch_sentences(wavs, params.get("sentence_silence_ms", 0), params.get("sentence_crossfade_ms", 0))}
+
+
+@app.get("/api/batching")
+async def batching_stats():
+    return JSONResponse(content=micro_batcher.stats())
+
+
+###########################
+#### REQUEST SCHEDULER ####
+###########################
+# Admission control in front of generation. At most scheduler_max_active requests generate at once, the rest wait
+# in a bounded queue per priority class and a free slot always goes to the highest class that is waiting, so a burst
+# of bulk jobs cannot hold back interactive replies. A full queue answers 429 straight away and a request that
+# waits longer than its class allows gets 503, both with a Retry-After estimated from recent generation times.
+class RequestScheduler:
+    # Highest priority first
+    CLASSES = ("stream", "file", "bulk")
+
+    def __init__(self, max_active=4, queue_limits=None, max_wait=None):
+        self.max_active = max(int(max_active), 1)
+        self.queue_limits = {"stream": 8, "file": 16, "bulk": 64, **(queue_limits or {})}
+        self.max_wait = {"stream": 10, "file": 30, "bulk": 300, **(max_wait or {})}
+        self.active = 0
+        self.waiting = {priority: deque() for priority in self.CLASSES}
+        self.admitted = {priority: 0 for priority in self.CLASSES}
+        self.shed = {priority: {"queue_full": 0, "timeout": 0} for priority in self.CLASSES}
+        self.cancelled = {priority: 0 for priority in self.CLASSES}
+        self.service_time = 5.0
+
+    def retry_after(self):
+        backlog = self.active + sum(len(queue) for queue in self.waiting.values())
+        return max(1, math.ceil(self.service_time * backlog / self.max_active))
+
+    def overloaded(self, status_code, reason):
+        return HTTPException(status_code=status_code, detail=reason, headers={"Retry-After": str(self.retry_after())})
+
+    # Returns the admission time, to be handed back to release()
+    async def acquire(self, priority):
+        if self.active < self.max_active and not any(self.waiting.values()):
+            self.active += 1
+            self.admitted[priority] += 1
+            return time.perf_counter()
+        if len(self.waiting[priority]) >= self.queue_limits[priority]:
+            self.shed[priority]["queue_full"] += 1
+            raise self.overloaded(429, f"The {priority} queue is full")
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[priority].append(future)
+        try:
+            await asyncio.wait_for(future, self.max_wait[priority])
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller gave up, pass it on
+                self.release(None)
+            elif future in self.waiting[priority]:
+                self.waiting[priority].remove(future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed[priority]["timeout"] += 1
+                raise self.overloaded(503, f"Timed out waiting in the {priority} queue")
+            raise
+        return time.perf_counter()
+
+    def release(self, admitted):
+        if admitted is not None:
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.perf_counter() - admitted)
+        # Hand the slot straight to the next waiter so a new arrival cannot jump the queue
+        for priority in self.CLASSES:
+            while self.waiting[priority]:
+                future = self.waiting[priority].popleft()
+                if not future.done():
+                    future.set_result(None)
+                    self.admitted[priority] += 1
+                    return
+        self.active -= 1
+
+    async def release_after(self, stream, admitted):
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.release(admitted)
+
+    def stats(self):
+        return {
+            "max_active": self.max_active,
+            "active": self.active,
+            "retry_after": self.retry_after(),
+            "classes": {
+                priority: {
+                    "queued": len(self.waiting[priority]),
+                    "queue_limit": self.queue_limits[priority],
+                    "max_wait": self.max_wait[priority],
+                    "admitted": self.admitted[priority],
+                    "shed": self.shed[priority],
+                    "cancelled": self.cancelled[priority],
+                }
+                for priority in self.CLASSES
+            },
+        }
+
+
+request_scheduler = RequestScheduler(
+    params.get("scheduler_max_active", 4), params.get("scheduler_queue_limits"), params.get("scheduler_max_wait_seconds")
+)
+
+
+# Blocks until the client hangs up. Only call once the request body has been read, or this would swallow it.
+async def wait_for_disconnect(request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+# Streams a response body until the client hangs up, then stops pulling from it so the generation behind it stops too
+async def stream_until_disconnect(stream, request, priority):
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(stream.__anext__())
+            await asyncio.wait({next_chunk, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_chunk.done():
+                next_chunk.cancel()
+                request_scheduler.cancelled[priority] += 1
+                return
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        watcher.cancel()
+        with contextlib.suppress(BaseException):
+            await stream.aclose()
+
+
+# Priority class of one request: a priority form field on endpoints that take one, else the X-Priority header, else
+# the endpoint's default
+def request_priority(request, requested, default, allowed):
+    if not requested and request is not None:
+        requested = request.headers.get("X-Priority")
+    if not requested:
+        return default
+    requested = requested.strip().lower()
+    if requested not in allowed:
+        raise HTTPException(status_code=400, detail=f"Unknown priority '{requested}', expected one of: {', '.join(allowed)}")
+    return requested
+
+
+# Endpoint decorator that holds a scheduler slot for the whole request, including the body of a streaming response.
+# The endpoint gives the default class, a caller can pick another of the allowed classes per request (see
+# request_priority). It also watches for the client going away. A request whose caller has gone is cancelled, whether
+# it is waiting for a slot or generating, so its queued inference jobs are dropped and a stream stops at its next
+# chunk. FastAPI only passes the request in when the endpoint asks for it, so endpoints without a Request parameter
+# are given one.
+def scheduled(default_priority, allowed=RequestScheduler.CLASSES):
+    def decorator(endpoint):
+        signature = inspect.signature(endpoint)
+        takes_request = any(parameter.annotation is HTTPRequest for parameter in signature.parameters.values())
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            request = kwargs.pop("disconnect_request", None)
+            if request is None:
+                request = next((value for value in [*args, *kwargs.values()] if isinstance(value, HTTPRequest)), None)
+                # Starlette style routes read the body themselves, cache it before the watcher starts listening
+                if args and request is args[0]:
+                    await request.body()
+            priority = request_priority(request, kwargs.get("priority"), default_priority, allowed)
+            admitted = None
+
+            async def admit_and_run():
+                nonlocal admitted
+                admitted = await request_scheduler.acquire(priority)
+                return await endpoint(*args, **kwargs)
+
+            job = asyncio.ensure_future(admit_and_run())
+            watcher = asyncio.ensure_future(wait_for_disconnect(request))
+            try:
+                await asyncio.wait({job, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                watcher.cancel()
+            if not job.done():
+                job.cancel()
+                with contextlib.suppress(BaseException):
+                    await job
+                request_scheduler.cancelled[priority] += 1
+                if admitted is not None:
+                    request_scheduler.release(None)
+                return Response(status_code=499)
+            try:
+                response = job.result()
+            except BaseException:
+                if admitted is not None:
+                    request_scheduler.release(admitted)
+                raise
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = request_scheduler.release_after(
+                    stream_until_disconnect(response.body_iterator, request, priority), admitted
+                )
+            else:
+                request_scheduler.release(admitted)
+            return response
+
+        if not takes_request:
+            wrapper.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter("disconnect_request", inspect.Parameter.KEYWORD_ONLY, annotation=HTTPRequest),
+            ])
+        return wrapper
+    return decorator
+
+
+@app.get("/api/scheduler")
+async def scheduler_status():
+    return JSONResponse(content={**request_scheduler.stats(), "executor": inference_executor.stats(), "batching": micro_batcher.stats()})
+
+
+######################
+#### RESULT CACHE ####
+######################
+class ResultCache:
+    """
+    On disk cache of finished generations, so a repeated line is copied out instead of synthesized again.
+    The key is a SHA-256 over a canonical JSON of everything that decides the audio: the whitespace
+    normalised text, the voice or blend identity, the generation settings, output format, model and seed.
+    Audio is stored under the SHA-256 of its contents, so identical audio cached under several keys is
+    kept once. Entries older than max_age are dropped and the least recently used go first once the
+    store is over max_bytes. Files are always copied in and out, never linked, as output files get
+    overwritten in place by later generations.
+    """
+    def __init__(self, cache_dir, max_bytes, max_age):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_bytes)
+        self.max_age = float(max_age)
+        self.index_path = self.cache_dir / "index.json"
+        self.index = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, **settings):
+        canonical = {"text": " ".join(unicodedata.normalize("NFC", text).split()), **settings}
+        canonical = {name: round(value, 6) if isinstance(value, float) else value for name, value in canonical.items()}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    # Path of the cached audio for key, or None on a miss
+    def lookup(self, key):
+        with self.lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is not None and time.time() - entry["created"] > self.max_age:
+                del index[key]
+                entry = None
+            if entry is None or not (self.cache_dir / entry["file"]).is_file():
+                self.misses += 1
+                return None
+            entry["used"] = time.time()
+            self.hits += 1
+            return self.cache_dir / entry["file"]
+
+    # Copies the cached audio for key to output_file, returning False on a miss
+    def deliver(self, key, output_file):
+        cached_path = self.lookup(key)
+        if cached_path is None:
+            return False
+        try:
+            shutil.copyfile(cached_path, output_file)
+        except FileNotFoundError:
+            # Evicted between the lookup and the copy
+            return False
+        return True
+
+    def put(self, key, audio_path):
+        with open(audio_path, "rb") as audio_file:
+            self.put_bytes(key, audio_file.read(), Path(audio_path).suffix)
+
+    def put_bytes(self, key, data, suffix):
+        digest = hashlib.sha256(data).hexdigest()
+        file_name = f"{digest[:2]}/{digest}{suffix}"
+        cached_path = self.cache_dir / file_name
+        if not cached_path.is_file():
+            cached_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = cached_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(temp_path, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, cached_path)
+        now = time.time()
+        with self.lock:
+            self._load_index()[key] = {"file": file_name, "size": len(data), "created": now, "used": now}
+            self._evict(keep=file_name)
+            self._save_index()
+
+    def _evict(self, keep=None):
+        index = self._load_index()
+        stored = {entry["file"] for entry in index.values()}
+        now = time.time()
+        for key in [key for key, entry in index.items() if now - entry["created"] > self.max_age]:
+            del index[key]
+        files = {}
+        for entry in index.values():
+            used, size = files.get(entry["file"], (0, entry["size"]))
+            files[entry["file"]] = (max(used, entry["used"]), size)
+        total = sum(size for _, size in files.values())
+        for file_name, (_, size) in sorted(files.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            if file_name == keep:
+                continue
+            for key in [key for key, entry in index.items() if entry["file"] == file_name]:
+                del index[key]
+            del files[file_name]
+            total -= size
+        # Remove stored audio no key points at any more, including the files of expired entries
+        for file_name in stored - set(files):
+            (self.cache_dir / file_name).unlink(missing_ok=True)
+
+    def _load_index(self):
+        if self.index is None:
+            try:
+                with open(self.index_path, "r") as index_file:
+                    self.index = json.load(index_file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.index = {}
+        return self.index
+
+    def _save_index(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.index_path.with_suffix(".tmp")
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
+
+    # Last used times change on every hit, write them out at shutdown so LRU order survives a restart
+    def save(self):
+        with self.lock:
+            if self.index is not None:
+                self._save_index()
+
+    def stats(self):
+        with self.lock:
+            index = self._load_index()
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(index),
+                "files": len({entry["file"] for entry in index.values()}),
+                "bytes": sum({entry["file"]: entry["size"] for entry in index.values()}.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+result_cache = ResultCache(
+    this_dir / params.get("result_cache_folder", "result_cache"),
+    max_bytes=float(params.get("result_cache_mb", 1024)) * 1024 * 1024,
+    max_age=float(params.get("result_cache_max_age_days", 30)) * 86400,
+)
+
+
+# Sentence fragments use the same store and rules as the result cache, kept apart so the two are sized separately
+fragment_cache = ResultCache(
+    this_dir / params.get("fragment_cache_folder", "fragment_cache"),
+    max_bytes=float(params.get("fragment_cache_mb", 512)) * 1024 * 1024,
+    max_age=float(params.get("result_cache_max_age_days", 30)) * 86400,
+)
+
+
+class FragmentMetrics:
+    """
+    Fragment cache hits per request: how many of a text's sentences were served from the cache.
+    """
+    def __init__(self, keep=200):
+        self.recent = deque(maxlen=keep)
+        self.requests = 0
+        self.sentences = 0
+        self.hits = 0
+
+    def record(self, sentences, hits):
+        self.requests += 1
+        self.sentences += sentences
+        self.hits += hits
+        self.recent.append({"sentences": sentences, "hits": hits, "hit_ratio": round(hits / sentences, 4) if sentences else 0.0})
+
+    def stats(self):
+        ratios = sorted(entry["hit_ratio"] for entry in self.recent)
+        return {
+            "requests": self.requests,
+            "sentences": self.sentences,
+            "sentence_hits": self.hits,
+            "sentence_hit_ratio": round(self.hits / self.sentences, 4) if self.sentences else 0.0,
+            "request_hit_ratio": {
+                "samples": len(ratios),
+                "mean": round(sum(ratios) / len(ratios), 4) if ratios else 0.0,
+                "p50": ratios[len(ratios) // 2] if ratios else 0.0,
+            },
+            "recent": list(self.recent)[-20:],
+        }
+
+
+fragment_metrics = FragmentMetrics()
+
+
+def load_fragments(keys):
+    wavs = []
+    for key in keys:
+        cached_path = fragment_cache.lookup(key)
+        try:
+            wavs.append(sf.read(cached_path, dtype="float32")[0] if cached_path is not None else None)
+        except (FileNotFoundError, RuntimeError):
+            wavs.append(None)
+    return wavs
+
+
+# Fragments are stored as float WAV so a cached sentence is bit identical to a freshly generated one
+def store_fragments(keys, wavs):
+    for key, wav in zip(keys, wavs):
+        wav_buf = io.BytesIO()
+        sf.write(wav_buf, np.asarray(wav, dtype=np.float32), 24000, format="WAV", subtype="FLOAT")
+        fragment_cache.put_bytes(key, wav_buf.getvalue(), ".wav")
+
+
+# Everything that decides how a single sentence sounds, before stitching and pitch shifting
+def xtts_fragment_settings(common_args, voice):
+    return {
+        "voice": voice,
+        "language": common_args["language"],
+        "temperature": common_args["temperature"],
+        "repetition_penalty": common_args["repetition_penalty"],
+        "speed": common_args["speed"],
+        "length_penalty": common_args["length_penalty"],
+        "top_k": common_args["top_k"],
+        "top_p": common_args["top_p"],
+        "model": current_model_identity(),
+    }
+
+
+# kind keeps file generations (whatever write_generated_audio produced) and streams (always a PCM16 WAV) apart, so a
+# key only ever holds one kind of audio
+def xtts_result_key(common_args, fragment_settings, output_file, pitch, preserve_duration, seed, kind="file"):
+    return result_cache.make_key(
+        common_args["text"],
+        kind=kind,
+        pitch=pitch,
+        preserve_duration=preserve_duration,
+        format=Path(output_file).suffix,
+        sentence_silence_ms=params.get("sentence_silence_ms", 0),
+        sentence_crossfade_ms=params.get("sentence_crossfade_ms", 0),
+        seed=seed,
+        **fragment_settings,
+    )
+
+
+# Non streaming XTTS generation to output_file through the result and fragment caches. voice_key returns the identity
+# of the voice or blend, it is only called when a cache is in use as it may need to hash a reference wav. A seed (the
+# request's, or generation_seed from the config) makes the output reproducible and is part of the cache keys.
+# use_cache None (the default) caches seeded generations only: an unseeded one samples fresh audio every time and
+# replaying a cached sample would quietly change that. True also caches unseeded generations, False never caches.
+async def generate_xtts_file(common_args, output_file, pitch, voice_key, preserve_duration=False, seed=None, use_cache=None):
+    if seed is None:
+        seed = params.get("generation_seed")
+    if use_cache is None:
+        use_cache = seed is not None
+    use_result_cache = use_cache and params.get("result_cache", False)
+    # Fragments are reused across different texts, so they stay seeded only even when the caller opts in
+    use_fragment_cache = use_cache and seed is not None and params.get("fragment_cache", False)
+    key = None
+    fragment_settings = None
+    if use_result_cache or use_fragment_cache:
+        fragment_settings = xtts_fragment_settings(common_args, str(await asyncio.to_thread(voice_key)))
+    if use_result_cache:
+        key = xtts_result_key(common_args, fragment_settings, output_file, pitch, preserve_duration, seed)
+        if await asyncio.to_thread(result_cache.deliver, key, output_file):
+            print(f"[{params['branding']}TTSGen] \033[94mServed from the result cache\033[0m")
+            return
+    output = await xtts_inference(common_args, seed, fragment_settings if use_fragment_cache else None)
+    await cpu_topology.encode(write_generated_audio, output["wav"], output_file, pitch, preserve_duration)
+    if key is not None:
+        await asyncio.to_thread(result_cache.put, key, output_file)
+
+
+# Result cache key for a stream, or None when streams should not be cached. Streams are unseeded, so a configured
+# generation_seed would promise a reproducibility they do not have.
+async def xtts_stream_key(common_args, output_file, voice_key, preserve_duration):
+    if not params.get("result_cache", False) or params.get("generation_seed") is not None:
+        return None
+    fragment_settings = xtts_fragment_settings(common_args, str(await asyncio.to_thread(voice_key)))
+    return xtts_result_key(common_args, fragment_settings, output_file, 0, preserve_duration, None, kind="stream")
+
+
+def read_cached(key):
+    cached_path = result_cache.lookup(key)
+    if cached_path is None:
+        return None
+    try:
+        with open(cached_path, "rb") as cached_file:
+            return cached_file.read()
+    except FileNotFoundError:
+        return None
+
+
+@app.get("/api/resultcache")
+async def result_cache_status():
+    return {**result_cache.stats(), "fragments": {**fragment_cache.stats(), "requests": fragment_metrics.stats()}}
+
+
 ########################
 #### TTS GENERATION ####
 ########################
 
 # TTS VOICE GENERATION METHODS (called from voice_preview and output_modifer)
-async def generate_audio(text, voice, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0):
+async def generate_audio(text, voice, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0, seed=None, use_cache=None, stream_settings=None):
     # Get the async generator from the internal function
-    response = generate_audio_internal(text, voice, language, temperature, repetition_penalty, output_file, streaming)
+    response = generate_audio_internal(text, voice, language, temperature, repetition_penalty, output_file, streaming, seed=seed, use_cache=use_cache, stream_settings=stream_settings)
     # If streaming, then return the generator as-is, otherwise just exhaust it and return
     if streaming:
         return response
     async for _ in response:
         pass
     
-async def generate_audio_local(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0):
+async def generate_audio_local(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0, seed=None, use_cache=None, stream_settings=None):
     # Get the async generator from the internal function
-    response = generate_audio_local_internal(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch)
+    response = generate_audio_local_internal(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, seed, use_cache, stream_settings)
     # If streaming, then return the generator as-is, otherwise just exhaust it and return
     if streaming:
         return response
     async for _ in response:
         pass
 
-async def generate_audio_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0):
+async def generate_audio_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming=False, speed=1.0, pitch=0, seed=None, use_cache=None, stream_settings=None):
     # Get the async generator from the internal function
-    response = generate_audio_internal_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch)
+    response = generate_audio_internal_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, seed, use_cache, stream_settings)
     # If streaming, then return the generator as-is, otherwise just exhaust it and return
     if streaming:
         return response
     async for _ in response:
         pass
 
-async def generate_audio_internal(text, voice, language, temperature, repetition_penalty, output_file, streaming, speed=1.0, pitch=0):
+@uses_model
+async def generate_audio_internal(text, voice, language, temperature, repetition_penalty, output_file, streaming, speed=1.0, pitch=0, seed=None, use_cache=None, stream_settings=None):
     global model
-    if params["low_vram"] and device == "cpu":
-        await switch_device()
     generate_start_time = time.time()  # Record the start time of generating TTS
     
     # XTTSv2 LOCAL & Xttsv2 FT Method
     if params["tts_method_xtts_local"] or tts_method_xtts_ft:
         print(f"[{params['branding']}TTSGen] {text}")
-        gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
-            audio_path=[f"{this_dir}/voices/{voice}"],
-            gpt_cond_len=model.config.gpt_cond_len,
-            max_ref_length=model.config.max_ref_len,
-            sound_norm_refs=model.config.sound_norm_refs,
-        )
+        if voice_embedding_store.has(voice):
+            gpt_cond_latent, speaker_embedding = await inference_executor.run(voice_embedding_store.get, voice)
+        else:
+            voice_prewarmer.record_use(voice)
+            gpt_cond_latent, speaker_embedding = await inference_executor.run(get_speaker_latents, this_dir / "voices" / voice)
 
         # Common arguments for both functions
         common_args = {
@@ -578,61 +3875,17 @@ async def generate_audio_internal(text, voice, language, temperature, repetition
             "speed": speed
         }
 
-        # Determine the correct inference function and add streaming specific argument if needed
-        inference_func = model.inference_stream if streaming else model.inference
-        if streaming:
-            common_args["stream_chunk_size"] = 20
-
-        # Call the appropriate function
-        output = inference_func(**common_args)
-
         # Process the output based on streaming or non-streaming
         if streaming:
-            # Streaming-specific operations
-            file_chunks = []
-            wav_buf = io.BytesIO()
-            with wave.open(wav_buf, "wb") as vfout:
-                vfout.setnchannels(1)
-                vfout.setsampwidth(2)
-                vfout.setframerate(24000)
-                vfout.writeframes(b"")
-            wav_buf.seek(0)
-            yield wav_buf.read()
-
-            for i, chunk in enumerate(output):
-                file_chunks.append(chunk)
-                if isinstance(chunk, list):
-                    chunk = torch.cat(chunk, dim=0)
-                chunk = chunk.clone().detach().cpu().numpy()
-                chunk = chunk[None, : int(chunk.shape[0])]
-                chunk = np.clip(chunk, -1, 1)
-                chunk = (chunk * 32767).astype(np.int16)
-                yield chunk.tobytes()
+            voice_key = lambda: voice_identity(voice if voice_embedding_store.has(voice) else this_dir / "voices" / voice)
+            async for chunk in stream_xtts_audio(common_args, stream_settings, output_file, voice_key, use_cache=use_cache):
+                yield chunk
         else:
-            # Non-streaming-specific operation
-            # torchaudio.save(output_file, torch.tensor(output["wav"]).unsqueeze(0), 24000)
-
-            wav_output_file = output_file.replace('mp3', 'wav')
-            torchaudio.save(wav_output_file, torch.tensor(output["wav"]).unsqueeze(0), 24000)
-            if pitch != 0:
-                
-                audio = AudioSegment.from_wav(wav_output_file)
-                octaves = pitch / 12
-                new_sample_rate = int(audio.frame_rate * (2 ** octaves))
-                hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
-                hipitched_sound = hipitched_sound.set_frame_rate(24000)  # 假设您想要的最终采样率是24000Hz
-
-                # 直接导出为MP3，不需要转回WAV然后再到MP3
-                hipitched_sound.export(output_file, format="mp3")
-                
-
-            else:
-                AudioSegment.from_wav(wav_output_file).export(output_file, format="mp3")
-
-
-
-
-
+            await generate_xtts_file(
+                common_args, output_file, pitch,
+                lambda: voice_identity(voice if voice_embedding_store.has(voice) else this_dir / "voices" / voice),
+                seed=seed, use_cache=use_cache,
+            )
     
     # API LOCAL Methods
     elif params["tts_method_api_local"]:
@@ -642,7 +3895,8 @@ async def generate_audio_internal(text, voice, language, temperature, repetition
 
         # Set the correct output path (different from the if statement)
         print(f"[{params['branding']}TTSGen] Using API Local")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -661,7 +3915,8 @@ async def generate_audio_internal(text, voice, language, temperature, repetition
             raise ValueError("Streaming is only supported in XTTSv2 local")
 
         print(f"[{params['branding']}TTSGen] Using API TTS")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -674,17 +3929,13 @@ async def generate_audio_internal(text, voice, language, temperature, repetition
     print(
         f"[{params['branding']}TTSGen] \033[93m{generate_elapsed_time:.2f} seconds. \033[94mLowVRAM: \033[33m{params['low_vram']} \033[94mDeepSpeed: \033[33m{params['deepspeed_activate']}\033[0m"
     )
-    # Move model back to cpu system ram if needed.
-    if params["low_vram"] and device == "cuda":
-        await switch_device()
     return
 
 
 
-async def generate_audio_local_internal(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch):
+@uses_model
+async def generate_audio_local_internal(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, seed=None, use_cache=None, stream_settings=None):
     global model
-    if params["low_vram"] and device == "cpu":
-        await switch_device()
     generate_start_time = time.time()  # Record the start time of generating TTS
     
     # XTTSv2 LOCAL & Xttsv2 FT Method
@@ -692,19 +3943,9 @@ async def generate_audio_local_internal(text, voices, weights, language, tempera
         print(f"[{params['branding']}TTSGen] {text}")
 
         #读取角色信息，加权求和再平均得到目标音色变量（weighted_gpt_cond_latent, weighted_speaker_embedding）
-        with open(this_dir / "data.json", 'r') as file:
-            information = json.load(file)
-            gpt_cond_latents = []
-            speaker_embeddings = []
-            for i in range(len(voices)):
-                gpt_cond_latent, speaker_embedding = information[voices[i]]["gpt_cond_latent"], information[voices[i]]["speaker_embedding"]
-                gpt_cond_latent, speaker_embedding = torch.tensor(gpt_cond_latent).to(device), torch.tensor(speaker_embedding).to(device)
-                gpt_cond_latents.append(gpt_cond_latent)
-                speaker_embeddings.append(speaker_embedding)
-            weighted_speaker_embeddings = [speaker_embedding * weight for speaker_embedding, weight in zip(speaker_embeddings, weights)]
-            weighted_gpt_cond_latents = [gpt_cond_latent * weight for gpt_cond_latent, weight in zip(gpt_cond_latents, weights)]
-            weighted_speaker_embedding = torch.mean(torch.stack(weighted_speaker_embeddings), dim=0)
-            weighted_gpt_cond_latent = torch.mean(torch.stack(weighted_gpt_cond_latents), dim=0)
+        weighted_gpt_cond_latent, weighted_speaker_embedding = await inference_executor.run(
+            get_blended_latents, voices, weights, voice_embedding_store.identity, voice_embedding_store.get_many
+        )
 
 
         # Common arguments for both functions
@@ -722,75 +3963,17 @@ async def generate_audio_local_internal(text, voices, weights, language, tempera
             "speed": speed
         }
 
-        # Determine the correct inference function and add streaming specific argument if needed
-        inference_func = model.inference_stream if streaming else model.inference
-        if streaming:
-            common_args["stream_chunk_size"] = 20
-
-        # Call the appropriate function
-        output = inference_func(**common_args)
-
         # Process the output based on streaming or non-streaming
         if streaming:
-            # Streaming-specific operations
-            file_chunks = []
-            wav_buf = io.BytesIO()
-            with wave.open(wav_buf, "wb") as vfout:
-                vfout.setnchannels(1)
-                vfout.setsampwidth(2)
-                vfout.setframerate(24000)
-                vfout.writeframes(b"")
-            wav_buf.seek(0)
-            yield wav_buf.read()
-
-            for i, chunk in enumerate(output):
-                file_chunks.append(chunk)
-                if isinstance(chunk, list):
-                    chunk = torch.cat(chunk, dim=0)
-                chunk = chunk.clone().detach().cpu().numpy()
-                chunk = chunk[None, : int(chunk.shape[0])]
-                chunk = np.clip(chunk, -1, 1)
-                chunk = (chunk * 32767).astype(np.int16)
-                yield chunk.tobytes()
+            voice_key = lambda: blend_cache.make_key([voice_embedding_store.identity(voice) for voice in voices], weights)
+            async for chunk in stream_xtts_audio(common_args, stream_settings, output_file, voice_key, use_cache=use_cache):
+                yield chunk
         else:
-            # Non-streaming-specific operation
-            wav_output_file = output_file.replace('mp3', 'wav')
-            torchaudio.save(wav_output_file, torch.tensor(output["wav"]).unsqueeze(0), 24000)
-            if pitch != 0:
-                
-                """
-                #读取音频文件，调用pydub库
-                #根据音调变化改变采样率
-                audio = AudioSegment.from_wav(wav_output_file)
-                octaves = pitch / 12
-                new_sample_rate = int(audio.frame_rate * (2 ** octaves))
-                hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
-                hipitched_sound = hipitched_sound.set_frame_rate(audio.frame_rate)
-                speed = hipitched_sound.duration_seconds/ audio.duration_seconds
-                hipitched_sound.export(wav_output_file+"1", format="wav")
-
-                #调用pyrubberband库
-                #将音调改变的文件改回原来的时长
-                y, sr = librosa.load(wav_output_file+"1", sr=None)
-                y_stretched = pyrubberband.time_stretch(y, sr, speed)
-                sf.write(output_file, y_stretched, sr, format='mp3')
-                
-                #######################
-                """
-                audio = AudioSegment.from_wav(wav_output_file)
-                octaves = pitch / 12
-                new_sample_rate = int(audio.frame_rate * (2 ** octaves))
-                hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
-                hipitched_sound = hipitched_sound.set_frame_rate(24000)  # 假设您想要的最终采样率是24000Hz
-
-                # 直接导出为MP3，不需要转回WAV然后再到MP3
-                hipitched_sound.export(output_file, format="mp3")
-            
-            else:
-                AudioSegment.from_wav(wav_output_file).export(output_file, format="mp3")
-
-
-
+            await generate_xtts_file(
+                common_args, output_file, pitch,
+                lambda: blend_cache.make_key([voice_embedding_store.identity(voice) for voice in voices], weights),
+                seed=seed, use_cache=use_cache,
+            )
     
     # API LOCAL Methods
     elif params["tts_method_api_local"]:
@@ -800,7 +3983,8 @@ async def generate_audio_local_internal(text, voices, weights, language, tempera
 
         # Set the correct output path (different from the if statement)
         print(f"[{params['branding']}TTSGen] Using API Local")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -819,7 +4003,8 @@ async def generate_audio_local_internal(text, voices, weights, language, tempera
             raise ValueError("Streaming is only supported in XTTSv2 local")
 
         print(f"[{params['branding']}TTSGen] Using API TTS")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -832,17 +4017,13 @@ async def generate_audio_local_internal(text, voices, weights, language, tempera
     print(
         f"[{params['branding']}TTSGen] \033[93m{generate_elapsed_time:.2f} seconds. \033[94mLowVRAM: \033[33m{params['low_vram']} \033[94mDeepSpeed: \033[33m{params['deepspeed_activate']}\033[0m"
     )
-    # Move model back to cpu system ram if needed.
-    if params["low_vram"] and device == "cuda":
-        await switch_device()
     return
 
 
 
-async def generate_audio_internal_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch):
+@uses_model
+async def generate_audio_internal_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, seed=None, use_cache=None, stream_settings=None):
     global model
-    if params["low_vram"] and device == "cpu":
-        await switch_device()
     generate_start_time = time.time()  # Record the start time of generating TTS
     
     # XTTSv2 LOCAL & Xttsv2 FT Method
@@ -850,25 +4031,10 @@ async def generate_audio_internal_v1(text, voices, weights, language, temperatur
         print(f"[{params['branding']}TTSGen] {text}")
 
         #加权求和再平均得到目标音色变量（weighted_gpt_cond_latent, weighted_speaker_embedding）
-        gpt_cond_latents = []
-        speaker_embeddings = []
-        for voice_url in voices:
-            voice = check_or_download_voice(voice_url)
-            gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
-                audio_path=[voice],
-                gpt_cond_len=model.config.gpt_cond_len,
-                max_ref_length=model.config.max_ref_len,
-                sound_norm_refs=model.config.sound_norm_refs,
-            )
-
-            gpt_cond_latent, speaker_embedding = torch.tensor(gpt_cond_latent).to(device), torch.tensor(speaker_embedding).to(device)
-            gpt_cond_latents.append(gpt_cond_latent)
-            speaker_embeddings.append(speaker_embedding)
-
-        weighted_speaker_embeddings = [speaker_embedding * weight for speaker_embedding, weight in zip(speaker_embeddings, weights)]
-        weighted_gpt_cond_latents = [gpt_cond_latent * weight for gpt_cond_latent, weight in zip(gpt_cond_latents, weights)]
-        weighted_speaker_embedding = torch.mean(torch.stack(weighted_speaker_embeddings), dim=0)
-        weighted_gpt_cond_latent = torch.mean(torch.stack(weighted_gpt_cond_latents), dim=0)    
+        voice_refs = [voice if voice_embedding_store.has(voice) else await voice_fetcher.fetch(voice) for voice in voices]
+        weighted_gpt_cond_latent, weighted_speaker_embedding = await inference_executor.run(
+            get_blended_latents, voice_refs, weights, voice_identity, load_voice_latents_batch
+        )
 
         # Common arguments for both functions
         common_args = {
@@ -885,105 +4051,18 @@ async def generate_audio_internal_v1(text, voices, weights, language, temperatur
             "speed": speed
         }
 
-
-        # print(f"[{params['branding']}TTSGen] {text}")
-        # gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
-        #     audio_path=[f"{this_dir}/voices/{voices[0]}"],
-        #     gpt_cond_len=model.config.gpt_cond_len,
-        #     max_ref_length=model.config.max_ref_len,
-        #     sound_norm_refs=model.config.sound_norm_refs,
-        # )
-
-        # # Common arguments for both functions
-        # common_args = {
-        #     "text": text,
-        #     "language": language,
-        #     "gpt_cond_latent": gpt_cond_latent,
-        #     "speaker_embedding": speaker_embedding,
-        #     "temperature": float(temperature),
-        #     "length_penalty": float(model.config.length_penalty),
-        #     "repetition_penalty": float(repetition_penalty),
-        #     "top_k": int(model.config.top_k),
-        #     "top_p": float(model.config.top_p),
-        #     "enable_text_splitting": True,
-        #     "speed": speed
-        # }
-
-        # Determine the correct inference function and add streaming specific argument if needed
-        inference_func = model.inference_stream if streaming else model.inference
-        if streaming:
-            common_args["stream_chunk_size"] = 20
-
-        # Call the appropriate function
-        output = inference_func(**common_args)
-
         # Process the output based on streaming or non-streaming
         if streaming:
-            # Streaming-specific operations
-            file_chunks = []
-            wav_buf = io.BytesIO()
-            with wave.open(wav_buf, "wb") as vfout:
-                vfout.setnchannels(1)
-                vfout.setsampwidth(2)
-                vfout.setframerate(24000)
-                vfout.writeframes(b"")
-            wav_buf.seek(0)
-            yield wav_buf.read()
-
-            for i, chunk in enumerate(output):
-                file_chunks.append(chunk)
-                if isinstance(chunk, list):
-                    chunk = torch.cat(chunk, dim=0)
-                chunk = chunk.clone().detach().cpu().numpy()
-                chunk = chunk[None, : int(chunk.shape[0])]
-                chunk = np.clip(chunk, -1, 1)
-                chunk = (chunk * 32767).astype(np.int16)
-                yield chunk.tobytes()
+            voice_key = lambda: blend_cache.make_key([voice_identity(voice) for voice in voice_refs], weights)
+            async for chunk in stream_xtts_audio(common_args, stream_settings, output_file, voice_key, preserve_duration=True, use_cache=use_cache):
+                yield chunk
         else:
-            # Non-streaming-specific operation
-            wav_output_file = output_file.replace('mp3', 'wav')
-            torchaudio.save(wav_output_file, torch.tensor(output["wav"]).unsqueeze(0), 24000)
-            if pitch != 0:
-                #最初版本，没有升降速
-                                
-                # audio = AudioSegment.from_wav(wav_output_file)
-                # octaves = pitch / 12
-                # new_sample_rate = int(audio.frame_rate * (2 ** octaves))
-                # hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
-                # hipitched_sound = hipitched_sound.set_frame_rate(24000)  # 假设您想要的最终采样率是24000Hz
-
-                # # 直接导出为MP3，不需要转回WAV然后再到MP3
-                # hipitched_sound.export(output_file, format="mp3")
-                
-
-                #lhr版本，根据pitch自适应升降速，保持语音时长不变
-                
-                speed = 1 / (2 ** (pitch / 12))
-                # 读取MP3文件并转换为WAV格式
-                audio = AudioSegment.from_wav(wav_output_file)
-                octaves = pitch / 12
-                new_sample_rate = int(audio.frame_rate * (2 ** octaves))
-                hipitched_sound = audio._spawn(audio.raw_data, overrides={'frame_rate': new_sample_rate})
-                hipitched_sound = hipitched_sound.set_frame_rate(24000)  # 设置最终采样率为24000Hz
-
-                # 使用pyrubberband处理时间拉伸
-                y, sr = librosa.load(hipitched_sound.export(format="wav"), sr=None)
-                y_stretched = pyrubberband.time_stretch(y, sr, speed)
-                # 直接导出为MP3，不需要转回WAV然后再到MP3
-                # hipitched_sound.export(output_file, format="mp3")
-                # y_stretched.export(output_file, format="mp3")
-                # 保存处理后的音频为MP3
-                sf.write(output_file, y_stretched, sr, format='wav')
-                final_audio = AudioSegment.from_wav(output_file)
-                final_audio.export(output_file, format="mp3")
-
-
-                
-            else:
-                AudioSegment.from_wav(wav_output_file).export(output_file, format="mp3")
-
-
-
+            #lhr版本，根据pitch自适应升降速，保持语音时长不变
+            await generate_xtts_file(
+                common_args, output_file, pitch,
+                lambda: blend_cache.make_key([voice_identity(voice) for voice in voice_refs], weights),
+                preserve_duration=True, seed=seed, use_cache=use_cache,
+            )
     
     # API LOCAL Methods
     elif params["tts_method_api_local"]:
@@ -991,11 +4070,10 @@ async def generate_audio_internal_v1(text, voices, weights, language, temperatur
         if streaming:
             raise ValueError("Streaming is only supported in XTTSv2 local")
 
-    
-
         # Set the correct output path (different from the if statement)
         print(f"[{params['branding']}TTSGen] Using API Local")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -1014,7 +4092,8 @@ async def generate_audio_internal_v1(text, voices, weights, language, temperatur
             raise ValueError("Streaming is only supported in XTTSv2 local")
 
         print(f"[{params['branding']}TTSGen] Using API TTS")
-        model.tts_to_file(
+        await inference_executor.run(
+            model.tts_to_file,
             text=text,
             file_path=output_file,
             speaker_wav=[f"{this_dir}/voices/{voice}"],
@@ -1027,15 +4106,13 @@ async def generate_audio_internal_v1(text, voices, weights, language, temperatur
     print(
         f"[{params['branding']}TTSGen] \033[93m{generate_elapsed_time:.2f} seconds. \033[94mLowVRAM: \033[33m{params['low_vram']} \033[94mDeepSpeed: \033[33m{params['deepspeed_activate']}\033[0m"
     )
-    # Move model back to cpu system ram if needed.
-    if params["low_vram"] and device == "cuda":
-        await switch_device()
     return
 
 
 
 # TTS VOICE GENERATION METHODS - generate TTS API
 @app.route("/api/generate", methods=["POST"])
+@scheduled("file")
 async def generate(request: Request):
     try:
         # Get parameters from JSON body
@@ -1047,8 +4124,11 @@ async def generate(request: Request):
         repetition_penalty = data["repetition_penalty"]
         output_file = data["output_file"]
         streaming = False
+        # Optional: a seed for reproducible output, and "cache" to override whether the result cache is used
+        seed = data.get("seed")
+        use_cache = data.get("cache")
         # Generation logic
-        response = await generate_audio(text, voice, language, temperature, repetition_penalty, output_file, streaming)
+        response = await generate_audio(text, voice, language, temperature, repetition_penalty, output_file, streaming, seed=seed, use_cache=use_cache)
         if streaming:
             return StreamingResponse(response, media_type="audio/wav")
         return JSONResponse(
@@ -1103,6 +4183,7 @@ def clean_old_files(folder_path: Path, keep_latest: int = 10):
 
 
 @app.route("/api/generate_local", methods=["POST"])
+@scheduled("file")
 async def generate_local(request: Request):
     try:
         # Get parameters from JSON body
@@ -1139,7 +4220,7 @@ async def generate_local(request: Request):
             speed = 1
         # Generation logic
         print("voices:{}, weights:{}, language:{}, speed:{}, pitch:{}".format(voices, weights, language, speed, pitch))
-        response = await generate_audio_local(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch)
+        response = await generate_audio_local(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, data.get("seed"), data.get("cache"))
         if streaming:
             return StreamingResponse(response, media_type="audio/wav")
         return JSONResponse(
@@ -1152,6 +4233,7 @@ async def generate_local(request: Request):
 # TTS VOICE GENERATION METHODS - generate TTS API
     
 @app.route("/api/v1/tts", methods=["POST"])
+@scheduled("file")
 async def generate_v1(request: Request):
     try:
         # Get parameters from JSON body
@@ -1186,7 +4268,7 @@ async def generate_v1(request: Request):
             speed = 1
         # Generation logic
         print("voices:{}, weights:{}, language:{}, speed:{}, pitch:{}".format(voices, weights, language, speed, pitch))
-        response = await generate_audio_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch)
+        response = await generate_audio_v1(text, voices, weights, language, temperature, repetition_penalty, output_file, streaming, speed, pitch, data.get("seed"), data.get("cache"))
         if streaming:
             return StreamingResponse(response, media_type="audio/wav")
         return JSONResponse(
@@ -1378,16 +4460,25 @@ async def update_settings(
 ##################################
 
 @app.get("/tts-demo-request", response_class=StreamingResponse)
-async def tts_demo_request_streaming(text: str, voice: str, language: str, output_file: str):
+@scheduled("stream")
+async def tts_demo_request_streaming(
+    text: str, voice: str, language: str, output_file: str, ttfa_ms: int = None, chunk_policy: str = None,
+    audio_format: str = Query(None, alias="format"), cache: bool = None,
+):
+    audio_format = stream_codec(audio_format)
+    output_file_path = output_path(output_file)
     try:
-        output_file_path = this_dir / "outputs" / output_file
-        stream = await generate_audio(text, voice, language, temperature, repetition_penalty, output_file_path, streaming=True)
-        return StreamingResponse(stream, media_type="audio/wav")
+        stream = await generate_audio(
+            text, voice, language, temperature, repetition_penalty, output_file_path, streaming=True,
+            use_cache=cache, stream_settings={"ttfa_ms": ttfa_ms, "policy": chunk_policy},
+        )
+        return streaming_audio_response(stream, audio_format)
     except Exception as e:
         print(f"An error occurred: {e}")
         return JSONResponse(content={"error": "An error occurred"}, status_code=500)
 
 @app.post("/tts-demo-request", response_class=JSONResponse)
+@scheduled("file")
 async def tts_demo_request(request: Request, text: str = Form(...), voice: str = Form(...), language: str = Form(...), output_file: str = Form(...)):
     try:
         output_file_path = this_dir / "outputs" / output_file
@@ -1432,12 +4523,83 @@ async def get_audio(filename: str):
 @app.get("/api/voices")
 async def get_voices():
     wav_files = list_files(this_dir / "voices")
-    return {"voices": wav_files}
+    return {"voices": wav_files, "registered_voices": voice_embedding_store.names()}
+
+################################
+#### VOICE REGISTRATION API ####
+################################
+# Compute the conditioning for uploaded audio once and keep it in the voice embedding store under a stable ID
+@app.post("/api/voices", response_class=JSONResponse)
+async def register_voice(file: UploadFile = File(...), name: str = Form(None), allow_duplicate: bool = Form(False)):
+    if not (params["tts_method_xtts_local"] or tts_method_xtts_ft):
+        return JSONResponse(content={"status": "error", "message": "Voice registration needs an XTTSv2 model loaded."}, status_code=400)
+    audio_bytes = await file.read()
+    if not audio_bytes:
+        return JSONResponse(content={"status": "error", "message": "No audio was uploaded."}, status_code=400)
+    voice_id = "voice_" + hashlib.sha256(audio_bytes).hexdigest()[:16]
+    if voice_embedding_store.has(voice_id):
+        return JSONResponse(content={"status": "register-exists", "voice_id": voice_id}, status_code=200)
+    upload_dir = this_dir / "voices" / "uploads"
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    upload_path = upload_dir / f"{voice_id}{Path(file.filename or '').suffix or '.wav'}"
+    try:
+        with open(upload_path, "wb") as upload_file:
+            upload_file.write(audio_bytes)
+        [(gpt_cond_latent, speaker_embedding)] = await inference_executor.run(
+            extract_conditioning_batch,
+            [upload_path],
+            gpt_cond_len=model.config.gpt_cond_len,
+            max_ref_length=model.config.max_ref_len,
+            sound_norm_refs=model.config.sound_norm_refs,
+        )
+        # Refuse near identical voices unless the caller asks for it, pointing them at the existing ID instead
+        duplicate_threshold = float(params.get("duplicate_similarity_threshold", 0.95))
+        nearest = await asyncio.to_thread(voice_similarity_index.search, speaker_embedding.detach().cpu().numpy(), 1)
+        if nearest and nearest[0]["similarity"] >= duplicate_threshold and not allow_duplicate:
+            return JSONResponse(
+                content={"status": "register-duplicate", "voice_id": nearest[0]["voice_id"], "similarity": nearest[0]["similarity"]},
+                status_code=409,
+            )
+        metadata = {"name": name or file.filename, "created": int(time.time())}
+        await asyncio.to_thread(voice_embedding_store.add, voice_id, gpt_cond_latent, speaker_embedding, metadata)
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
+    finally:
+        upload_path.unlink(missing_ok=True)
+    print(f"[{params['branding']}TTSGen] Registered voice \033[93m{voice_id}\033[0m ({metadata['name']})")
+    return JSONResponse(content={"status": "register-success", "voice_id": voice_id}, status_code=200)
+
+
+@app.get("/api/voices/{voice_id}")
+async def get_registered_voice(voice_id: str):
+    description = voice_embedding_store.describe(voice_id)
+    if description is None:
+        raise HTTPException(status_code=404, detail="Voice not found")
+    return description
+
+
+@app.get("/api/voices/{voice_id}/similar")
+async def get_similar_voices(voice_id: str, k: int = 10):
+    embedding = await asyncio.to_thread(voice_similarity_index.embedding_of, voice_id)
+    if embedding is None:
+        raise HTTPException(status_code=404, detail="Voice not found")
+    start = time.perf_counter()
+    similar = await asyncio.to_thread(voice_similarity_index.search, embedding, max(k, 1), voice_id)
+    return {"voice_id": voice_id, "similar": similar, "search_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+
+@app.delete("/api/voices/{voice_id}")
+async def delete_registered_voice(voice_id: str):
+    removed = await asyncio.to_thread(voice_embedding_store.remove, voice_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail="Voice not found")
+    return {"status": "delete-success", "voice_id": voice_id}
 
 ###########################
 #### PREVIEW VOICE API ####
 ###########################
 @app.post("/api/previewvoice/", response_class=JSONResponse)
+@scheduled("file")
 async def preview_voice(request: Request, voice: str = Form(...)):
     try:
         # Hardcoded settings
@@ -1477,26 +4639,33 @@ async def preview_voice(request: Request, voice: str = Form(...)):
 import html
 import re
 import uuid
-import numpy as np
 import soundfile as sf
 import sys
-import hashlib
 
 ##############################
 #### Streaming Generation ####
 ##############################
 
 @app.get("/api/tts-generate-streaming", response_class=StreamingResponse)
-async def tts_generate_streaming(text: str, voice: str, language: str, output_file: str):
+@scheduled("stream")
+async def tts_generate_streaming(
+    text: str, voice: str, language: str, output_file: str, ttfa_ms: int = None, chunk_policy: str = None,
+    audio_format: str = Query(None, alias="format"), cache: bool = None,
+):
+    audio_format = stream_codec(audio_format)
+    output_file_path = output_path(output_file)
     try:
-        output_file_path = this_dir / "outputs" / output_file
-        stream = await generate_audio(text, voice, language, temperature, repetition_penalty, output_file_path, streaming=True)
-        return StreamingResponse(stream, media_type="audio/wav")
+        stream = await generate_audio(
+            text, voice, language, temperature, repetition_penalty, output_file_path, streaming=True,
+            use_cache=cache, stream_settings={"ttfa_ms": ttfa_ms, "policy": chunk_policy},
+        )
+        return streaming_audio_response(stream, audio_format)
     except Exception as e:
         print(f"An error occurred: {e}")
         return JSONResponse(content={"error": "An error occurred"}, status_code=500)
 
 @app.post("/api/tts-generate-streaming", response_class=JSONResponse)
+@scheduled("file")
 async def tts_generate_streaming(request: Request, text: str = Form(...), voice: str = Form(...), language: str = Form(...), output_file: str = Form(...)):
     try:
         output_file_path = this_dir / "outputs" / output_file
@@ -1506,6 +4675,173 @@ async def tts_generate_streaming(request: Request, text: str = Form(...), voice:
         print(f"An error occurred: {e}")
         return JSONResponse(content={"error": "An error occurred"}, status_code=500)
 
+#############################
+#### WebSocket Streaming ####
+#############################
+# Text in, audio out over one WebSocket, for LLM front ends that want speech to start with the first sentence rather
+# than the finished reply. ws://localhost:7851/api/tts-stream-ws?voice=female_01.wav&language=en
+# Client messages are JSON:
+#   {"type": "text", "text": "..."}  a piece of the reply, sentences are synthesized as soon as they are complete
+#   {"type": "flush"}                synthesize whatever text is buffered now, answered with {"type": "flushed"}
+#   {"type": "close"}                flush, finish every queued sentence, send {"type": "done"} and close
+# The server sends {"type": "format"} first, {"type": "sentence"} and {"type": "sentence_end"} around each sentence,
+# and the audio as binary frames: a little endian uint32 sequence number followed by PCM16 mono samples. Sequence
+# numbers run on across sentences, so a gap or reordering is easy to spot. Each sentence takes a stream slot from the
+# request scheduler while it is synthesized, not for the life of the connection.
+class SentenceSplitter:
+    """
+    Finds complete sentences in text that arrives a piece at a time. A sentence ends at ., !, ? or … (with any
+    closing quotes or brackets) once whitespace follows, so "3.5" is not split while the 5 is still on its way, at
+    CJK end punctuation, or at a line break. Text longer than max_chars with no end yet is cut at the last comma or
+    space so a run-on sentence never holds up synthesis.
+    """
+    BOUNDARY = re.compile(r"[。！？]+|[.!?…]+[\"'”’)\]]*(?=\s)|\n+")
+
+    def __init__(self, max_chars=250):
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    @staticmethod
+    def speakable(sentences):
+        return [sentence for sentence in sentences if any(character.isalnum() for character in sentence)]
+
+    def feed(self, text):
+        self.buffer += text
+        sentences = []
+        match = self.BOUNDARY.search(self.buffer)
+        while match is not None:
+            sentences.append(self.buffer[:match.end()].strip())
+            self.buffer = self.buffer[match.end():]
+            match = self.BOUNDARY.search(self.buffer)
+        while len(self.buffer) > self.max_chars:
+            cut = max(self.buffer.rfind(",", 0, self.max_chars), self.buffer.rfind(" ", 0, self.max_chars)) + 1
+            cut = cut if cut > 0 else self.max_chars
+            sentences.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+        return self.speakable(sentences)
+
+    def flush(self):
+        sentence, self.buffer = self.buffer.strip(), ""
+        return self.speakable([sentence])
+
+
+_WS_FLUSHED = object()
+
+
+@app.websocket("/api/tts-stream-ws")
+async def tts_stream_websocket(websocket: WebSocket):
+    await websocket.accept()
+    if not (params["tts_method_xtts_local"] or tts_method_xtts_ft):
+        await websocket.send_json({"type": "error", "detail": "WebSocket streaming needs an XTTS model"})
+        await websocket.close(code=1011)
+        return
+    query = websocket.query_params
+    voice = query.get("voice", params["voice"])
+    language = query.get("language", "en")
+    try:
+        if voice_embedding_store.has(voice):
+            gpt_cond_latent, speaker_embedding = await inference_executor.run(voice_embedding_store.get, voice)
+        else:
+            voice_prewarmer.record_use(voice)
+            gpt_cond_latent, speaker_embedding = await inference_executor.run(get_speaker_latents, this_dir / "voices" / voice)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        await websocket.send_json({"type": "error", "detail": f"Voice {voice} could not be loaded"})
+        await websocket.close(code=1011)
+        return
+    common_args = {
+        "language": language,
+        "gpt_cond_latent": gpt_cond_latent,
+        "speaker_embedding": speaker_embedding,
+        "temperature": float(query.get("temperature", temperature)),
+        "length_penalty": float(model.config.length_penalty),
+        "repetition_penalty": float(query.get("repetition_penalty", repetition_penalty)),
+        "top_k": int(model.config.top_k),
+        "top_p": float(model.config.top_p),
+        "enable_text_splitting": True,
+        "speed": 1.0,
+    }
+    chunking = stream_chunking({"ttfa_ms": query.get("ttfa_ms") and int(query["ttfa_ms"]), "policy": query.get("chunk_policy")})
+    splitter = SentenceSplitter(model.tokenizer.char_limits.get(language.split("-")[0], 250))
+    sentences = asyncio.Queue()
+    sequence = 0
+
+    async def synthesize():
+        nonlocal sequence
+        index = 0
+        while True:
+            sentence = await sentences.get()
+            if sentence is None:
+                return
+            if sentence is _WS_FLUSHED:
+                await websocket.send_json({"type": "flushed", "sequence": sequence})
+                continue
+            try:
+                admitted = await request_scheduler.acquire("stream")
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "index": index, "detail": e.detail})
+                index += 1
+                continue
+            try:
+                await websocket.send_json({"type": "sentence", "index": index, "text": sentence, "sequence": sequence})
+                start = time.perf_counter()
+                ttfa = None
+                report = None
+                async for item in inference_executor.stream(xtts_stream_pcm, chunking=chunking, text=sentence, **common_args):
+                    if isinstance(item, dict):
+                        report = item
+                        continue
+                    if ttfa is None:
+                        ttfa = time.perf_counter() - start
+                    await websocket.send_bytes(struct.pack("<I", sequence) + item)
+                    sequence += 1
+                stream_metrics.record(ttfa, report)
+                await websocket.send_json({"type": "sentence_end", "index": index, "sequence": sequence})
+            finally:
+                request_scheduler.release(admitted)
+            index += 1
+
+    await websocket.send_json({"type": "format", "sample_rate": 24000, "channels": 1, "sample_width": 2})
+    worker = asyncio.ensure_future(synthesize())
+    try:
+        while True:
+            receive = asyncio.ensure_future(websocket.receive_json())
+            await asyncio.wait({receive, worker}, return_when=asyncio.FIRST_COMPLETED)
+            if not receive.done():
+                # The worker only stops early when it fails, result() raises its error
+                receive.cancel()
+                worker.result()
+                return
+            message = receive.result()
+            kind = message.get("type") if isinstance(message, dict) else None
+            if kind == "text":
+                for sentence in splitter.feed(str(message.get("text", ""))):
+                    sentences.put_nowait(sentence)
+            elif kind in ("flush", "close"):
+                for sentence in splitter.flush():
+                    sentences.put_nowait(sentence)
+                if kind == "close":
+                    sentences.put_nowait(None)
+                    await worker
+                    await websocket.send_json({"type": "done", "sequence": sequence})
+                    await websocket.close()
+                    return
+                sentences.put_nowait(_WS_FLUSHED)
+            else:
+                await websocket.send_json({"type": "error", "detail": "Expected a JSON message with type text, flush or close"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        with contextlib.suppress(Exception):
+            await websocket.send_json({"type": "error", "detail": "An error occurred"})
+            await websocket.close(code=1011)
+    finally:
+        # Leaving the stream early stops generation of the current sentence and frees its worker
+        worker.cancel()
+        with contextlib.suppress(BaseException):
+            await worker
+
 ##############################
 #### Standard Generation ####
 ##############################
@@ -1538,9 +4874,9 @@ class Request(BaseModel):
 class JSONInput(BaseModel):
     text_input: str = Field(..., max_length=2000, description="text_input needs to be 2000 characters or less.")
     text_filtering: str = Field(..., pattern="^(none|standard|html)$", description="text_filtering needs to be 'none', 'standard' or 'html'.")
-    character_voice_gen: str = Field(..., pattern="^.*\.wav$", description="character_voice_gen needs to be the name of a wav file e.g. mysample.wav.")
+    character_voice_gen: str = Field(..., pattern="^(.*\.wav|voice_[0-9a-f]{16})$", description="character_voice_gen needs to be the name of a wav file e.g. mysample.wav or a registered voice ID.")
     narrator_enabled: bool = Field(..., description="narrator_enabled needs to be true or false.")
-    narrator_voice_gen: str = Field(..., pattern="^.*\.wav$", description="narrator_voice_gen needs to be the name of a wav file e.g. mysample.wav.")
+    narrator_voice_gen: str = Field(..., pattern="^(.*\.wav|voice_[0-9a-f]{16})$", description="narrator_voice_gen needs to be the name of a wav file e.g. mysample.wav or a registered voice ID.")
     text_not_inside: str = Field(..., pattern="^(character|narrator)$", description="text_not_inside needs to be 'character' or 'narrator'.")
     language: str = Field(..., pattern="^(ar|zh-cn|cs|nl|en|fr|de|hu|it|ja|ko|pl|pt|ru|es|tr)$", description="language needs to be one of the following ar|zh-cn|cs|nl|en|fr|de|hu|it|ja|ko|pl|pt|ru|es|tr.")
     output_file_name: str = Field(..., pattern="^[a-zA-Z0-9_]+$", description="output_file_name needs to be the name without any special characters or file extension e.g. 'filename'")
@@ -1652,6 +4988,7 @@ def combine(output_file_timestamp, output_file_name, audio_files):
 
 # Generation API (separate from text-generation-webui)
 @app.post("/api/tts-generate", response_class=JSONResponse)
+@scheduled("file")
 async def tts_generate(
     text_input: str = Form(...),
     text_filtering: str = Form(...),
@@ -1665,6 +5002,10 @@ async def tts_generate(
     autoplay: bool = Form(...),
     autoplay_volume: float = Form(...),
     streaming: bool = Form(False),
+    seed: int = Form(None),
+    cache: bool = Form(None),
+    # Scheduler class for this request, e.g. "bulk" for batch jobs that should yield to interactive callers
+    priority: str = Form(None),
 ):
     try:
         json_input_data = {
@@ -1713,7 +5054,7 @@ async def tts_generate(
                 cleaned_part = re.sub(r'\n+', ' ', cleaned_part)
                 output_file = this_dir / "outputs" / f"{output_file_name}_{uuid.uuid4()}_{int(time.time())}.wav"
                 output_file_str = output_file.as_posix()
-                response = await generate_audio(cleaned_part, voice_to_use, language,temperature, repetition_penalty, output_file_str, streaming)
+                response = await generate_audio(cleaned_part, voice_to_use, language,temperature, repetition_penalty, output_file_str, streaming, seed=seed, use_cache=cache)
                 audio_path = output_file_str
                 audio_files_all_paragraphs.append(audio_path)
             # Combine audio files across paragraphs
@@ -1750,7 +5091,7 @@ async def tts_generate(
                 cleaned_string = re.sub(r'\n+', ' ', cleaned_string)
             else:
                 cleaned_string = text_input
-            response = await generate_audio(cleaned_string, character_voice_gen, language, temperature, repetition_penalty, output_file_path, streaming)
+            response = await generate_audio(cleaned_string, character_voice_gen, language, temperature, repetition_penalty, output_file_path, streaming, seed=seed, use_cache=cache)
         if sounddevice_installed == False or streaming == True:
             autoplay = False
         if autoplay:
@@ -1790,7 +5131,9 @@ def get_current_settings():
         "deepspeed_available": deepspeed_available,
         "deepspeed_status": params["deepspeed_activate"],
         "low_vram_status": params["low_vram"],
-        "finetuned_model": finetuned_model
+        "finetuned_model": finetuned_model,
+        "cpu_profile": cpu_profile_state,
+        "cpu_topology": cpu_topology.stats(),
     }
     return settings  # Automatically converted to JSON by Fas
 
@@ -1838,7 +5181,7 @@ async def transcribe_audio(file: UploadFile = File(...)):
             temp_file.write(content)
         
         # 使用Whisper模型转换音频为文字
-        result = STT_model.transcribe(temp_file_path)
+        result = await inference_executor.run(cpu_topology.run_whisper, STT_model.transcribe, temp_file_path)
         text = result["text"]
         
         # 清理临时文件